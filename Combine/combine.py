@@ -3,41 +3,57 @@ import sys
 import os
 import argparse
 import time
+import threading
+from collections import deque
 import shlex
+import json
+import functools
 
 DEBUG = False
+STDERR_TAIL_LINES = 64
+ENCODE_PRESET = "veryfast"
+SOFTWARE_ENCODER_ARGS = ['-c:v', 'libx264', '-preset', ENCODE_PRESET, '-pix_fmt', 'yuv420p']
+# QSV only takes nv12 input; the others accept yuv420p like libx264
+HARDWARE_ENCODER_ARGS = {
+    'h264_nvenc': ['-c:v', 'h264_nvenc', '-preset', 'p1', '-rc', 'vbr', '-pix_fmt', 'yuv420p'],
+    'h264_qsv': ['-c:v', 'h264_qsv', '-preset', 'veryfast', '-pix_fmt', 'nv12'],
+    'h264_videotoolbox': ['-c:v', 'h264_videotoolbox', '-pix_fmt', 'yuv420p'],
+    'h264_amf': ['-c:v', 'h264_amf', '-quality', 'speed', '-pix_fmt', 'yuv420p'],
+}
+_encoder_args = None
 
 def debug_print(*args, **kwargs):
     if DEBUG:
         print(*args, **kwargs)
 
-def run_command(command, suppress_errors=False, timeout=None, retries=1):
+def wait_with_stderr_tail(process, timeout=None):
+    # Keep just the end of ffmpeg's stderr; the full progress log of a long encode is never read
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    reader = threading.Thread(target=lambda: tail.extend(process.stderr), daemon=True)
+    reader.start()
+    return_code = process.wait(timeout=timeout)
+    reader.join()
+    return return_code, ''.join(tail)
+
+def run_command(command, suppress_errors=False, timeout=None, retries=1, capture_stdout=True):
+    stream_stderr = not capture_stdout and not DEBUG and not suppress_errors
     attempt = 0
     while attempt < retries:
         debug_print(f"Running command (Attempt {attempt+1}/{retries}): {command}")
         stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
         stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
-        output, errors = [], []
         try:
-            stdout_data, stderr_data = process.communicate(timeout=timeout)
-            if stdout_data:
-                debug_print(stdout_data, end='')
-                output.append(stdout_data)
-            if stderr_data:
-                debug_print(stderr_data, end='')
-                errors.append(stderr_data)
-            return_code = process.returncode
-            output_str = ''.join(output)
-            error_str = ''.join(errors)
-            debug_print(f"Command finished: return_code={return_code}")
-            if return_code != 0:
-                if not suppress_errors:
-                    debug_print(f"Error: return_code={return_code}. Output: {output_str}\nErrors: {error_str}")
-                return False, output_str + "\n" + error_str
-            return True, output_str
+            if stream_stderr:
+                process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+                try:
+                    return_code, error_str = wait_with_stderr_tail(process, timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    raise
+                result = subprocess.CompletedProcess(command, return_code, "", error_str)
+            else:
+                result = subprocess.run(command, stdout=stdout, stderr=stderr, text=True, timeout=timeout)
         except subprocess.TimeoutExpired:
-            process.kill()
             attempt += 1
             if attempt < retries:
                 debug_print(f"Timeout after {timeout}s. Retrying {attempt}/{retries}")
@@ -45,13 +61,21 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
                 continue
             debug_print(f"Timeout after {timeout}s. No more retries")
             return False, f"Timeout after {timeout}s"
-        except Exception as ex:
-            process.kill()
+        except OSError as ex:
             debug_print(f"Error: {ex}")
             return False, str(ex)
-        finally:
-            if process.poll() is None:
-                process.terminate()
+        output_str = result.stdout or ""
+        error_str = result.stderr or ""
+        if output_str:
+            debug_print(output_str, end='')
+        if error_str:
+            debug_print(error_str, end='')
+        debug_print(f"Command finished: return_code={result.returncode}")
+        if result.returncode != 0:
+            if not suppress_errors:
+                debug_print(f"Error: return_code={result.returncode}. Output: {output_str}\nErrors: {error_str}")
+            return False, output_str + "\n" + error_str
+        return True, output_str
 
 def get_next_available_name(output_dir, prefix, extension, start_number=1):
     number = start_number
@@ -62,22 +86,42 @@ def get_next_available_name(output_dir, prefix, extension, start_number=1):
             return name, full_path, number + 1
         number += 1
 
-def get_file_duration(file_path):
-    if not os.access(file_path, os.R_OK):
-        print(f"Error: Cannot read file {file_path}")
-        return 0
-    command = f'ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{file_path}"'
+@functools.lru_cache(maxsize=128)
+def probe_file(file_path, size, mtime_ns):
+    command = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', file_path]
     debug_print(f"Running ffprobe: {command}")
     success, output = run_command(command)
     if not success:
         print(f"Error: ffprobe failed for {file_path}: {output}")
-        command = f'ffprobe -v error -show_entries stream=duration -select_streams v:0 -of default=noprint_wrappers=1:nokey=1 "{file_path}"'
-        debug_print(f"Trying fallback ffprobe: {command}")
-        success, output = run_command(command)
-        if not success:
-            print(f"Error: Fallback ffprobe failed for {file_path}: {output}")
-            return 0
-    output = output.strip()
+        return None
+    try:
+        return json.loads(output)
+    except json.JSONDecodeError:
+        print(f"Error: Invalid ffprobe output for {file_path}")
+        return None
+
+def ffprobe_info(file_path):
+    if not os.access(file_path, os.R_OK):
+        print(f"Error: Cannot read file {file_path}")
+        return None
+    st = os.stat(file_path)
+    return probe_file(file_path, st.st_size, st.st_mtime_ns)
+
+def get_streams(file_path, codec_type):
+    info = ffprobe_info(file_path)
+    if not info:
+        return []
+    return [s for s in info.get('streams', []) if s.get('codec_type') == codec_type]
+
+def get_file_duration(file_path):
+    info = ffprobe_info(file_path)
+    if not info:
+        return 0
+    output = str(info.get('format', {}).get('duration', ''))
+    if not output:
+        video_streams = get_streams(file_path, 'video')
+        output = str(video_streams[0].get('duration', '')) if video_streams else ''
+        debug_print(f"Using video stream duration: '{output}'")
     debug_print(f"Duration output: '{output}'")
     if not output:
         print(f"Warning: Empty duration for {file_path}")
@@ -90,51 +134,79 @@ def get_file_duration(file_path):
         print(f"Error: Invalid duration for {file_path}: '{output}'")
         return 0
 
+def get_frame_rate(stream):
+    num, _, den = stream.get('r_frame_rate', '').partition('/')
+    try:
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0
+
 def has_video_stream(file_path):
-    if not os.access(file_path, os.R_OK):
-        print(f"Error: Cannot read file {file_path}")
-        return False
-    command = f'ffprobe -v error -show_streams -select_streams v -of default=noprint_wrappers=1 "{file_path}"'
-    debug_print(f"Checking video: {command}")
-    success, output = run_command(command)
-    if not success:
-        debug_print(f"No video stream in {file_path}: {output}")
-        return False
-    return bool(output.strip())
+    return bool(get_streams(file_path, 'video'))
 
 def has_audio_stream(file_path):
-    if not os.access(file_path, os.R_OK):
-        print(f"Error: Cannot read file {file_path}")
-        return False
-    command = f'ffprobe -v error -show_streams -select_streams a -of default=noprint_wrappers=1 "{file_path}"'
-    debug_print(f"Checking audio: {command}")
-    success, output = run_command(command)
-    if not success:
-        debug_print(f"No audio stream in {file_path}: {output}")
-        return False
-    return bool(output.strip())
+    return bool(get_streams(file_path, 'audio'))
+
+def encoder_works(encoder_args):
+    # The -encoders list reflects the ffmpeg build, not the installed GPU, so prove the encoder on one frame
+    command = [
+        'ffmpeg', '-hide_banner', '-f', 'lavfi', '-i', 'color=s=256x256:d=0.1',
+        *encoder_args, '-frames:v', '1', '-f', 'null', '-'
+    ]
+    success, _ = run_command(command, suppress_errors=True, timeout=30)
+    return success
+
+def get_encoder_args():
+    global _encoder_args
+    if _encoder_args is None:
+        _encoder_args = SOFTWARE_ENCODER_ARGS
+        success, output = run_command(['ffmpeg', '-hide_banner', '-encoders'], timeout=30)
+        if success:
+            for encoder, encoder_args in HARDWARE_ENCODER_ARGS.items():
+                if encoder in output and encoder_works(encoder_args):
+                    _encoder_args = encoder_args
+                    break
+        debug_print(f"Video encoder: {_encoder_args[1]}")
+    return _encoder_args
+
+def disable_hardware_encoder():
+    global _encoder_args
+    _encoder_args = SOFTWARE_ENCODER_ARGS
+
+def build_encode_command(video_file, audio_file, output_path, loop_count, encoder_args, rate_flag, final_duration):
+    return [
+        'ffmpeg', '-y', '-i', video_file, '-stream_loop', str(loop_count - 1), '-i', audio_file,
+        '-map', '0:v:0?', '-map', '1:a:0?', *encoder_args, '-b:v', '3500k', *rate_flag,
+        '-c:a', 'aac', '-b:a', '128k', '-ar', '44100', '-shortest', '-t', str(final_duration), output_path
+    ]
 
 def try_ffmpeg_command(video_file, audio_file, output_path, use_simplified=False):
+    encoder_args = None
     if use_simplified:
-        ffmpeg_command = (
-            f'ffmpeg -y -i "{video_file}" -i "{audio_file}" '
-            f'-map 0:v:0? -map 1:a:0? -c:v copy -c:a copy -shortest "{output_path}"'
-        )
+        ffmpeg_command = [
+            'ffmpeg', '-y', '-i', video_file, '-i', audio_file,
+            '-map', '0:v:0?', '-map', '1:a:0?', '-c:v', 'copy', '-c:a', 'copy', '-shortest', output_path
+        ]
     else:
         video_duration = get_file_duration(video_file)
         audio_duration = get_file_duration(audio_file)
         if video_duration == 0 or audio_duration == 0:
             print(f"Warning: Could not get duration for video ({video_duration}s) or audio ({audio_duration}s). Using simplified FFmpeg command.")
             return try_ffmpeg_command(video_file, audio_file, output_path, use_simplified=True)
+        # Only resample when the source is faster than 30fps; slower sources keep their own frames
+        video_streams = get_streams(video_file, 'video')
+        rate_flag = [] if video_streams and 0 < get_frame_rate(video_streams[0]) <= 30 else ['-r', '30']
         loop_count = max(0, int(video_duration // audio_duration) + (1 if video_duration % audio_duration > 0 else 0))
         final_duration = video_duration
-        ffmpeg_command = (
-            f'ffmpeg -y -i "{video_file}" -stream_loop {loop_count-1} -i "{audio_file}" '
-            f'-map 0:v:0? -map 1:a:0? -c:v libx264 -preset ultrafast -b:v 3500k -r 30 -pix_fmt yuv420p '
-            f'-c:a aac -b:a 128k -ar 44100 -shortest -t {final_duration} "{output_path}"'
-        )
+        encoder_args = get_encoder_args()
+        ffmpeg_command = build_encode_command(video_file, audio_file, output_path, loop_count, encoder_args, rate_flag, final_duration)
     
-    success, output = run_command(ffmpeg_command, timeout=300)
+    success, output = run_command(ffmpeg_command, timeout=300, capture_stdout=False)
+    if not success and encoder_args not in (None, SOFTWARE_ENCODER_ARGS):
+        debug_print(f"Hardware encoder failed, falling back to libx264: {output}")
+        disable_hardware_encoder()
+        ffmpeg_command = build_encode_command(video_file, audio_file, output_path, loop_count, SOFTWARE_ENCODER_ARGS, rate_flag, final_duration)
+        success, output = run_command(ffmpeg_command, timeout=300, capture_stdout=False)
     return success, output
 
 def main():
@@ -142,9 +214,12 @@ def main():
     parser = argparse.ArgumentParser(description="Combine two MP4 files: one for video, one for audio")
     parser.add_argument("input_dir", help="Input directory containing two MP4 files")
     parser.add_argument("output_dir", help="Output directory for the combined file")
+    parser.add_argument("--cpu-encode", action="store_true", help="Always encode with libx264, even if a hardware encoder is available")
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
     args = parser.parse_args()
     DEBUG = args.debug
+    if args.cpu_encode:
+        disable_hardware_encoder()
 
     input_dir = os.path.abspath(args.input_dir)
     output_dir = os.path.abspath(args.output_dir)
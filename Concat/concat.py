@@ -5,42 +5,47 @@ import argparse
 import glob
 import json
 import time
+import threading
+from collections import deque
 import shutil
+import functools
 from PIL import Image
 
 DEBUG = False
+STDERR_TAIL_LINES = 64
 
 def debug_print(*args, **kwargs):
     if DEBUG:
         print(*args, **kwargs)
 
-def run_command(command, suppress_errors=False, timeout=None, retries=1):
+def wait_with_stderr_tail(process, timeout=None):
+    # Normalize and concat passes print progress for every frame; hold on to the last lines only
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    reader = threading.Thread(target=lambda: tail.extend(process.stderr), daemon=True)
+    reader.start()
+    return_code = process.wait(timeout=timeout)
+    reader.join()
+    return return_code, ''.join(tail)
+
+def run_command(command, suppress_errors=False, timeout=None, retries=1, capture_stdout=True):
+    stream_stderr = not capture_stdout and not DEBUG and not suppress_errors
     attempt = 0
     while attempt <= retries:
         debug_print(f"Running command (Attempt {attempt+1}/{retries+1}): {command}")
         stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
         stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
-        output, errors = [], []
         try:
-            stdout_data, stderr_data = process.communicate(timeout=timeout)
-            if stdout_data:
-                debug_print(stdout_data, end='')
-                output.append(stdout_data)
-            if stderr_data:
-                debug_print(stderr_data, end='')
-                errors.append(stderr_data)
-            return_code = process.returncode
-            output_str = ''.join(output)
-            error_str = ''.join(errors)
-            debug_print(f"Command finished: return_code={return_code}")
-            if return_code != 0:
-                if not suppress_errors:
-                    debug_print(f"Error: return_code={return_code}. Output: {output_str}\nErrors: {error_str}")
-                return False, output_str + "\n" + error_str
-            return True, output_str
+            if stream_stderr:
+                process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+                try:
+                    return_code, error_str = wait_with_stderr_tail(process, timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    raise
+                result = subprocess.CompletedProcess(command, return_code, "", error_str)
+            else:
+                result = subprocess.run(command, stdout=stdout, stderr=stderr, text=True, timeout=timeout)
         except subprocess.TimeoutExpired:
-            process.kill()
             attempt += 1
             if attempt <= retries:
                 debug_print(f"Timeout after {timeout}s. Retrying {attempt}/{retries}")
@@ -48,13 +53,21 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
                 continue
             debug_print(f"Timeout after {timeout}s. No more retries")
             return False, f"Timeout after {timeout}s"
-        except Exception as ex:
-            process.kill()
+        except OSError as ex:
             debug_print(f"Error: {ex}")
             return False, str(ex)
-        finally:
-            if process.poll() is None:
-                process.terminate()
+        output_str = result.stdout or ""
+        error_str = result.stderr or ""
+        if output_str:
+            debug_print(output_str, end='')
+        if error_str:
+            debug_print(error_str, end='')
+        debug_print(f"Command finished: return_code={result.returncode}")
+        if result.returncode != 0:
+            if not suppress_errors:
+                debug_print(f"Error: return_code={result.returncode}. Output: {output_str}\nErrors: {error_str}")
+            return False, output_str + "\n" + error_str
+        return True, output_str
 
 def get_next_available_name(output_dir, prefix, extension, start_number=1):
     number = start_number
@@ -65,25 +78,62 @@ def get_next_available_name(output_dir, prefix, extension, start_number=1):
             return name, full_path, number + 1
         number += 1
 
-def has_audio_stream(file_path):
-    command = f'ffprobe -v error -show_streams -select_streams a -of default=noprint_wrappers=1 "{file_path}"'
-    debug_print(f"Checking audio: {command}")
+def silent_remove(file_path):
+    try:
+        os.remove(file_path)
+        return True
+    except FileNotFoundError:
+        return False
+
+@functools.lru_cache(maxsize=128)
+def probe_file(file_path, size, mtime_ns):
+    command = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', file_path]
+    debug_print(f"Running ffprobe: {command}")
     success, output = run_command(command)
-    return bool(output.strip())
+    if not success:
+        return None
+    try:
+        return json.loads(output)
+    except json.JSONDecodeError:
+        return None
+
+def ffprobe_info(file_path):
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return probe_file(file_path, st.st_size, st.st_mtime_ns)
+
+def get_streams(file_path, codec_type):
+    info = ffprobe_info(file_path)
+    if not info:
+        return []
+    return [s for s in info.get('streams', []) if s.get('codec_type') == codec_type]
+
+def has_audio_stream(file_path):
+    return bool(get_streams(file_path, 'audio'))
 
 def get_video_dimensions(file_path):
-    command = f'ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of json "{file_path}"'
-    success, output = run_command(command)
-    if success:
-        try:
-            data = json.loads(output)
-            if data.get('streams'):
-                return data['streams'][0]['width'], data['streams'][0]['height']
-        except json.JSONDecodeError:
-            pass
+    video_streams = get_streams(file_path, 'video')
+    if video_streams and video_streams[0].get('width') and video_streams[0].get('height'):
+        return video_streams[0]['width'], video_streams[0]['height']
     print(f"Warning: Could not get dimensions for {file_path}. Using 1920x1080")
     return 1920, 1080
 
+def build_normalize_command(file_path, temp_output_path, has_audio, ffmpeg_preset, video_filter_string):
+    # Silent inputs get a generated silent track so every segment has the same streams for the concat filter
+    silence_input = [] if has_audio else ['-f', 'lavfi', '-i', 'anullsrc=channel_layout=stereo:sample_rate=48000']
+    shortest_flag = [] if has_audio else ['-shortest']
+    return [
+        'ffmpeg', '-y', '-i', file_path,
+        *silence_input,
+        '-c:v', 'libx264', '-preset', ffmpeg_preset, '-b:v', '5000k', '-r', '30', '-pix_fmt', 'yuv420p',
+        '-force_key_frames', 'expr:gte(t,n_forced*2)',
+        '-c:a', 'aac', '-b:a', '192k', '-ar', '48000', '-ac', '2', *shortest_flag,
+        '-vf', video_filter_string,
+        temp_output_path
+    ]
+
 def extract_number(filename):
     import re
     match = re.search(r'_(\d+)_', filename)
@@ -211,27 +261,9 @@ def main():
         for i, file_path in enumerate(input_files):
             temp_output_name, temp_output_path, _ = get_next_available_name(temp_dir, f"Temp_{i+1}", ".mp4")
             has_audio = has_audio_stream(file_path)
-            if has_audio:
-                ffmpeg_command = (
-                    f'ffmpeg -y -i "{file_path}" '
-                    f'-c:v libx264 -preset {ffmpeg_preset} -b:v 5000k -r 30 -pix_fmt yuv420p '
-                    f'-force_key_frames "expr:gte(t,n_forced*2)" '
-                    f'-c:a aac -b:a 192k -ar 48000 -ac 2 '
-                    f'-vf "{video_filter_string}" '
-                    f'"{temp_output_path}"'
-                )
-            else:
-                ffmpeg_command = (
-                    f'ffmpeg -y -i "{file_path}" '
-                    f'-f lavfi -i anullsrc=channel_layout=stereo:sample_rate=48000 '
-                    f'-c:v libx264 -preset {ffmpeg_preset} -b:v 5000k -r 30 -pix_fmt yuv420p '
-                    f'-force_key_frames "expr:gte(t,n_forced*2)" '
-                    f'-c:a aac -b:a 192k -ar 48000 -ac 2 -shortest '
-                    f'-vf "{video_filter_string}" '
-                    f'"{temp_output_path}"'
-                )
+            ffmpeg_command = build_normalize_command(file_path, temp_output_path, has_audio, ffmpeg_preset, video_filter_string)
             debug_print(f"FFmpeg command for {os.path.basename(file_path)}: {ffmpeg_command}")
-            success, output = run_command(ffmpeg_command, timeout=300, retries=1)
+            success, output = run_command(ffmpeg_command, timeout=300, retries=1, capture_stdout=False)
             if success and os.path.exists(temp_output_path):
                 print(f"Processed {os.path.basename(file_path)} as {temp_output_path.replace(os.sep, '/')}")
                 if file_path.replace(os.sep, '/') not in existing_videos:
@@ -242,30 +274,32 @@ def main():
                 sys.exit(1)
 
         # Concatenate using concat filter
-        input_string = " ".join([f"-i \"{v}\"" for v in processed_videos])
+        input_args = [arg for v in processed_videos for arg in ('-i', v)]
+        # Probe each processed video once and reuse the answers for the filter, map and codec flags
+        audio_flags = [has_audio_stream(v) for v in processed_videos]
+        any_audio = any(audio_flags)
         filter_inputs = []
         stream_map = []
-        for i, video in enumerate(processed_videos):
-            has_audio = has_audio_stream(video)
+        for i, has_audio in enumerate(audio_flags):
             filter_inputs.append(f"[{i}:v]")
             stream_map.append(f"{i}:v")
             if has_audio:
                 filter_inputs.append(f"[{i}:a]")
                 stream_map.append(f"{i}:a")
 
-        concat_filter = f"{' '.join(filter_inputs)}concat=n={len(processed_videos)}:v=1:a={1 if any(has_audio_stream(v) for v in processed_videos) else 0}[outv]{'[outa]' if any(has_audio_stream(v) for v in processed_videos) else ''}"
-        map_string = "-map [outv]" + (" -map [outa]" if any(has_audio_stream(v) for v in processed_videos) else " -an")
+        concat_filter = f"{' '.join(filter_inputs)}concat=n={len(processed_videos)}:v=1:a={1 if any_audio else 0}[outv]{'[outa]' if any_audio else ''}"
+        map_args = ['-map', '[outv]'] + (['-map', '[outa]'] if any_audio else ['-an'])
         final_output_path = existing_output if existing_output and os.path.exists(existing_output) else os.path.join(output_dir, get_next_available_name(output_dir, "Concat", ".mp4")[1])
-        ffmpeg_command = (
-            f'ffmpeg -y {input_string} '
-            f'-filter_complex "{concat_filter}" '
-            f'{map_string} '
-            f'-c:v libx264 -preset {ffmpeg_preset} -b:v 5000k -r 30 -pix_fmt yuv420p '
-            f'{"-c:a aac -b:a 192k -ar 48000 -ac 2" if any(has_audio_stream(v) for v in processed_videos) else "-an"} '
-            f'"{final_output_path}"'
-        )
+        ffmpeg_command = [
+            'ffmpeg', '-y', *input_args,
+            '-filter_complex', concat_filter,
+            *map_args,
+            '-c:v', 'libx264', '-preset', ffmpeg_preset, '-b:v', '5000k', '-r', '30', '-pix_fmt', 'yuv420p',
+            *(['-c:a', 'aac', '-b:a', '192k', '-ar', '48000', '-ac', '2'] if any_audio else ['-an']),
+            final_output_path
+        ]
         debug_print(f"FFmpeg concat command: {ffmpeg_command}")
-        success, output = run_command(ffmpeg_command, timeout=600, retries=1)
+        success, output = run_command(ffmpeg_command, timeout=600, retries=1, capture_stdout=False)
         if success:
             print(f"Saved as {final_output_path.replace(os.sep, '/')} ({len(processed_videos)} segments)")
             metadata["output_video"] = final_output_path.replace(os.sep, '/')
@@ -274,8 +308,7 @@ def main():
             print(f"Saved metadata to {metadata_file.replace(os.sep, '/')}")
             # Clean up temporary files
             for video in processed_videos:
-                if os.path.exists(video):
-                    os.remove(video)
+                if silent_remove(video):
                     debug_print(f"Removed temporary file: {video}")
         else:
             print(f"Concatenation failed: {output}")
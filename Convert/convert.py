@@ -11,6 +11,8 @@ import logging
 import shutil
 import hashlib
 import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,6 +23,20 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 DEBUG = False
+FORCE_REENCODE = False
+# veryfast sits at the knee of x264's speed/size curve: close to ultrafast's speed at a much better quality per bit
+ENCODE_PRESET = "veryfast"
+# libx264 runs single-pass CRF capped at 5M; the hardware encoders keep the fixed 3500k target
+SOFTWARE_ENCODER_ARGS = ['-c:v', 'libx264', '-preset', ENCODE_PRESET, '-crf', '23', '-maxrate', '5M', '-bufsize', '10M']
+HARDWARE_ENCODER_ARGS = {
+    'h264_nvenc': ['-c:v', 'h264_nvenc', '-preset', 'p1', '-rc', 'vbr', '-b:v', '3500k'],
+    'h264_qsv': ['-c:v', 'h264_qsv', '-preset', 'veryfast', '-b:v', '3500k'],
+    'h264_videotoolbox': ['-c:v', 'h264_videotoolbox', '-b:v', '3500k'],
+    'h264_amf': ['-c:v', 'h264_amf', '-quality', 'speed', '-b:v', '3500k'],
+}
+_encoder_args = None
+# Conversions run on a thread pool; detection and fallback must not interleave between workers
+_encoder_lock = threading.Lock()
 
 def debug_print(*args, **kwargs):
     if DEBUG:
@@ -32,20 +48,9 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
         debug_print(f"Running command (Attempt {attempt+1}/{retries}): {command}")
         stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
         stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
         try:
-            stdout_data, stderr_data = process.communicate(timeout=timeout)
-            if stdout_data:
-                debug_print(f"STDOUT: {stdout_data}")
-            if stderr_data:
-                debug_print(f"STDERR: {stderr_data}")
-            return_code = process.returncode
-            if return_code != 0 and not suppress_errors:
-                debug_print(f"Error: return_code={return_code}")
-                return False, stdout_data + "\n" + stderr_data
-            return True, stdout_data
+            result = subprocess.run(command, stdout=stdout, stderr=stderr, text=True, timeout=timeout)
         except subprocess.TimeoutExpired:
-            process.kill()
             if attempt < retries - 1:
                 debug_print(f"Timeout after {timeout}s. Retrying {attempt+1}/{retries}")
                 time.sleep(2)
@@ -54,12 +59,19 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
             debug_print(f"Timeout after {timeout}s. No more retries")
             return False, f"Timeout after {timeout}s"
         except Exception as ex:
-            process.kill()
             debug_print(f"Command execution error: {ex}")
             return False, str(ex)
-        finally:
-            if process.poll() is None:
-                process.terminate()
+        stdout_data = result.stdout or ""
+        stderr_data = result.stderr or ""
+        if stdout_data:
+            debug_print(f"STDOUT: {stdout_data}")
+        if stderr_data:
+            debug_print(f"STDERR: {stderr_data}")
+        if result.returncode != 0:
+            if not suppress_errors:
+                debug_print(f"Error: return_code={result.returncode}")
+            return False, stdout_data + "\n" + stderr_data
+        return True, stdout_data
 
 def get_file_hash(file_path):
     hash_md5 = hashlib.md5()
@@ -71,20 +83,54 @@ def get_file_hash(file_path):
     except Exception:
         return str(uuid.uuid4())[:8]
 
-def get_video_dimensions(video_path):
-    command = f'ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of json "{video_path}"'
+def silent_remove(file_path):
+    try:
+        os.remove(file_path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def get_stream_info(video_path):
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name,pix_fmt,width,height,r_frame_rate',
+               '-of', 'json', video_path]
     success, output = run_command(command)
     if success:
         try:
-            data = json.loads(output)
-            if data.get('streams'):
-                return data['streams'][0]['width'], data['streams'][0]['height']
+            return json.loads(output).get('streams', [])
         except json.JSONDecodeError:
             logger.warning(f"JSON decode error for {video_path}: {output}")
+    return []
+
+def get_video_dimensions(video_path, streams=None):
+    if streams is None:
+        streams = get_stream_info(video_path)
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    if video and video.get('width') and video.get('height'):
+        return video['width'], video['height']
     logger.warning(f"Could not get dimensions for {video_path}. Using 1920x1080")
     return 1920, 1080
 
+def get_frame_rate(stream):
+    num, _, den = stream.get('r_frame_rate', '').partition('/')
+    try:
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0
+
+def can_remux(streams):
+    # Sources already in the standard format (H.264 yuv420p at up to 30fps, AAC audio) only need a stream copy
+    video = [s for s in streams if s.get('codec_type') == 'video']
+    audio = [s for s in streams if s.get('codec_type') == 'audio']
+    if len(video) != 1 or len(audio) > 1:
+        return False
+    if video[0].get('codec_name') != 'h264' or video[0].get('pix_fmt') != 'yuv420p':
+        return False
+    if not 0 < get_frame_rate(video[0]) <= 30:
+        return False
+    return all(a.get('codec_name') == 'aac' for a in audio)
+
 def convert_image(input_path, output_path, target_ratio=None, crop=False):
+    temp_output_path = output_path + ".tmp"
     try:
         with Image.open(input_path) as img:
             img = img.convert("RGB")
@@ -139,61 +185,122 @@ def convert_image(input_path, output_path, target_ratio=None, crop=False):
             else:
                 new_img = img
 
-            temp_output_path = output_path + ".tmp"
             new_img.save(temp_output_path, "JPEG", quality=100)
             os.replace(temp_output_path, output_path)
             debug_print(f"Converted {input_path} to {output_path} (Size: {new_img.size}) with ratio {target_ratio}")
             return True
     except Exception as e:
         logger.error(f"Image conversion error for {input_path}: {e}")
-        if os.path.exists(temp_output_path):
-            os.remove(temp_output_path)
+        if silent_remove(temp_output_path):
             debug_print(f"Removed failed temp file: {temp_output_path}")
         return False
 
-def convert_video(input_path, output_path, target_ratio=None, duration=None):
+def encoder_works(ffmpeg_path, encoder_args):
+    # -encoders lists what the build was compiled with, not the GPUs this machine has, so encode one test frame
+    command = [
+        ffmpeg_path, '-hide_banner', '-f', 'lavfi', '-i', 'color=s=256x256:d=0.1',
+        *encoder_args, '-frames:v', '1', '-f', 'null', '-'
+    ]
+    success, _ = run_command(command, suppress_errors=True, timeout=30)
+    return success
+
+def get_encoder_args(ffmpeg_path):
+    global _encoder_args
+    with _encoder_lock:
+        if _encoder_args is None:
+            chosen = SOFTWARE_ENCODER_ARGS
+            success, output = run_command([ffmpeg_path, '-hide_banner', '-encoders'], timeout=30)
+            if success:
+                for encoder, encoder_args in HARDWARE_ENCODER_ARGS.items():
+                    if encoder in output and encoder_works(ffmpeg_path, encoder_args):
+                        chosen = encoder_args
+                        break
+            _encoder_args = chosen
+            debug_print(f"Video encoder: {_encoder_args[1]}")
+        return _encoder_args
+
+def disable_hardware_encoder():
+    global _encoder_args
+    with _encoder_lock:
+        _encoder_args = SOFTWARE_ENCODER_ARGS
+
+def build_video_command(ffmpeg_path, input_path, temp_output_path, encoder_args, vf_flag, rate_flag, duration_flag, threads=None):
+    thread_flag = ['-threads', str(threads)] if threads else []
+    return [
+        ffmpeg_path, '-y', '-i', input_path, *encoder_args, *thread_flag,
+        *vf_flag, *rate_flag, '-c:a', 'aac', '-b:a', '128k', '-ar', '44100', *duration_flag,
+        '-movflags', '+faststart', '-f', 'mp4', temp_output_path
+    ]
+
+def fits_target(width, height, target_ratio):
+    # Videos only get a scale filter for 9:16, which fits them inside 540x960; a source already that size passes through unchanged
+    if target_ratio != "9:16":
+        return True
+    if width % 2 or height % 2:
+        return False
+    return (width == 540 and height <= 960) or (height == 960 and width <= 540)
+
+def convert_video(input_path, output_path, target_ratio=None, duration=None, threads=None):
     ffmpeg_path = "ffmpeg"
     debug_print(f"Testing FFmpeg at {ffmpeg_path}")
-    success, output = run_command(f'"{ffmpeg_path}" -version')
+    success, output = run_command([ffmpeg_path, '-version'])
     if not success:
         debug_print(f"FFmpeg not found via PATH. Output: {output}")
         ffmpeg_path = r"C:\ffmpeg\bin\ffmpeg.exe"
         debug_print(f"Trying explicit path {ffmpeg_path}")
-        success, output = run_command(f'"{ffmpeg_path}" -version')
+        success, output = run_command([ffmpeg_path, '-version'])
         if not success:
             logger.error(f"FFmpeg not found at {ffmpeg_path}. Install or adjust path.")
             return False
 
-    width, height = get_video_dimensions(input_path)
+    streams = get_stream_info(input_path)
+    width, height = get_video_dimensions(input_path, streams)
     debug_print(f"Video {input_path} size: {width}x{height}")
 
-    duration_flag = f"-t {duration}" if duration is not None else ""
-    if target_ratio == "9:16":
-        temp_output_path = output_path + ".tmp"
-        ffmpeg_command = (
-            f'"{ffmpeg_path}" -y -i "{input_path}" -c:v libx264 -preset ultrafast -b:v 3500k '
-            f'-vf "scale=540:960:force_original_aspect_ratio=decrease,pad=ceil(iw/2)*2:ceil(ih/2)*2:0:0" '
-            f'-r 30 -c:a aac -b:a 128k -ar 44100 {duration_flag} -f mp4 "{temp_output_path}"'
-        )
+    duration_flag = ['-t', str(duration)] if duration is not None else []
+    # Only resample when the source is faster than 30fps; slower sources keep their own frames
+    video = next((st for st in streams if st.get('codec_type') == 'video'), {})
+    rate_flag = [] if 0 < get_frame_rate(video) <= 30 else ['-r', '30']
+    temp_output_path = output_path + ".tmp"
+    fits = fits_target(width, height, target_ratio)
+    if not fits:
+        vf_flag = ['-vf', 'scale=540:960:force_original_aspect_ratio=decrease,pad=ceil(iw/2)*2:ceil(ih/2)*2:0:0']
     else:
-        temp_output_path = output_path + ".tmp"
-        ffmpeg_command = (
-            f'"{ffmpeg_path}" -y -i "{input_path}" -c:v libx264 -preset ultrafast -b:v 3500k '
-            f'-r 30 -c:a aac -b:a 128k -ar 44100 {duration_flag} -f mp4 "{temp_output_path}"'
-        )
-
-    debug_print(f"Executing: {ffmpeg_command}")
-    success, output = run_command(ffmpeg_command, retries=2)
+        vf_flag = []
+    success = False
+    if not FORCE_REENCODE and can_remux(streams) and fits:
+        debug_print(f"{input_path} already matches the standard format, copying streams")
+        # Map only video and audio: mkv/webm subtitle and data streams cannot be muxed into mp4
+        ffmpeg_command = [
+            ffmpeg_path, '-y', '-i', input_path, '-map', '0:v:0', '-map', '0:a?', '-c', 'copy',
+            *duration_flag, '-movflags', '+faststart', '-f', 'mp4', temp_output_path
+        ]
+        debug_print(f"Executing: {ffmpeg_command}")
+        success, output = run_command(ffmpeg_command, retries=2)
+        if not success:
+            debug_print(f"Stream copy failed, re-encoding instead: {output}")
+    if not success:
+        encoder_args = get_encoder_args(ffmpeg_path)
+        ffmpeg_command = build_video_command(ffmpeg_path, input_path, temp_output_path, encoder_args, vf_flag, rate_flag, duration_flag, threads)
+        debug_print(f"Executing: {ffmpeg_command}")
+        success, output = run_command(ffmpeg_command, retries=2)
+        if not success and encoder_args != SOFTWARE_ENCODER_ARGS:
+            debug_print(f"Hardware encoder failed, falling back to libx264: {output}")
+            disable_hardware_encoder()
+            ffmpeg_command = build_video_command(ffmpeg_path, input_path, temp_output_path, SOFTWARE_ENCODER_ARGS, vf_flag, rate_flag, duration_flag, threads)
+            debug_print(f"Executing: {ffmpeg_command}")
+            success, output = run_command(ffmpeg_command, retries=2)
     if success:
-        out_width, out_height = get_video_dimensions(temp_output_path)
-        debug_print(f"Output dimensions: {out_width}x{out_height}")
+        if DEBUG:
+            # The output probe only feeds the debug log, so skip the extra ffprobe otherwise
+            out_width, out_height = get_video_dimensions(temp_output_path)
+            debug_print(f"Output dimensions: {out_width}x{out_height}")
         os.replace(temp_output_path, output_path)
         debug_print(f"Saved as {output_path.replace(os.sep, '/')} (Target: 540x960 if 9:16)")
         return True
     else:
         logger.error(f"Conversion failed for {input_path}: {output}")
-        if os.path.exists(temp_output_path):
-            os.remove(temp_output_path)
+        if silent_remove(temp_output_path):
             debug_print(f"Removed failed temp file: {temp_output_path}")
         return False
 
@@ -219,7 +326,17 @@ def get_files_recursive(directory, extensions):
         debug_print(f"Sorting error: {e}. Falling back to alphabetical sort.")
         return sorted(files)
 
-def get_next_available_name(output_dir, prefix, file_type, start_number=1, duration=None):
+def get_existing_names(output_dir):
+    try:
+        with os.scandir(output_dir) as entries:
+            return {os.path.normcase(entry.name) for entry in entries}
+    except OSError:
+        return set()
+
+def get_next_available_name(output_dir, prefix, file_type, start_number=1, duration=None, existing=None):
+    # Callers naming many files pass one scanned set and get each claimed name added to it
+    if existing is None:
+        existing = get_existing_names(output_dir)
     number = start_number
     duration_suffix = f"_{duration}s" if duration is not None else "_full"
     while True:
@@ -229,43 +346,44 @@ def get_next_available_name(output_dir, prefix, file_type, start_number=1, durat
             name = f"{prefix}_Uni_{number}{duration_suffix}.mp4"
         full_path = os.path.join(output_dir, name)
         debug_print(f"Checking output path: {full_path}")
-        if not os.path.exists(full_path):
+        if os.path.normcase(name) not in existing:
+            existing.add(os.path.normcase(name))
             debug_print(f"Available name: {full_path}")
             return name, full_path, number + 1
         number += 1
 
-def log_conversion(input_path, output_path, output_dir, duration=None):
+def load_conversion_log(output_dir):
     log_file = os.path.join(output_dir, "conversion_log.json")
-    entry = {
+    try:
+        with open(log_file, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+    except json.JSONDecodeError:
+        logger.warning("Error reading conversion_log.json")
+        return []
+
+def save_conversion_log(output_dir, log_data):
+    log_file = os.path.join(output_dir, "conversion_log.json")
+    temp_log_file = log_file + ".tmp"
+    os.makedirs(output_dir, exist_ok=True)
+    with open(temp_log_file, 'w') as f:
+        json.dump(log_data, f, indent=4)
+    os.replace(temp_log_file, log_file)
+
+def log_conversion(log_data, input_path, output_path, duration=None):
+    log_data.append({
         "input_path": input_path,
         "output_path": output_path,
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
         "duration": duration,
         "type": "image" if output_path.lower().endswith(".jpg") else "video"
-    }
-    if os.path.exists(log_file):
-        with open(log_file, 'r') as f:
-            try:
-                log_data = json.load(f)
-            except json.JSONDecodeError:
-                log_data = []
-    else:
-        log_data = []
-    log_data.append(entry)
-    with open(log_file, 'w') as f:
-        json.dump(log_data, f, indent=4)
+    })
 
-def get_existing_conversion(input_path, output_dir, prefix, file_type, duration=None):
-    log_file = os.path.join(output_dir, "conversion_log.json")
-    if os.path.exists(log_file):
-        with open(log_file, 'r') as f:
-            try:
-                log_data = json.load(f)
-                for entry in log_data:
-                    if entry["input_path"] == input_path and entry.get("duration") == duration and entry["type"] == file_type:
-                        return entry["output_path"]
-            except json.JSONDecodeError:
-                logger.warning("Error reading conversion_log.json")
+def get_existing_conversion(log_data, input_path, file_type, duration=None):
+    for entry in log_data:
+        if entry["input_path"] == input_path and entry.get("duration") == duration and entry["type"] == file_type:
+            return entry["output_path"]
     return None
 
 def main():
@@ -280,9 +398,14 @@ def main():
     parser.add_argument("--nine_sixteen", action="store_true", help="Force 9:16 aspect ratio")
     parser.add_argument("--crop", action="store_true", help="Crop images to fit target aspect ratio")
     parser.add_argument("--t", type=int, default=None, help="Limit output video duration in seconds (default: process entire video)")
+    parser.add_argument("--force-reencode", action="store_true", help="Re-encode videos even when they could be stream-copied")
+    parser.add_argument("--cpu-encode", action="store_true", help="Always encode with libx264, even if a hardware encoder is available")
     args = parser.parse_args()
-    global DEBUG
+    global DEBUG, FORCE_REENCODE
     DEBUG = args.debug
+    FORCE_REENCODE = args.force_reencode
+    if args.cpu_encode:
+        disable_hardware_encoder()
 
     input_paths = args.input_dirs
     prefix = args.prefix
@@ -301,6 +424,11 @@ def main():
 
     image_count = 1
     video_count = 1
+    jobs = []
+    queued = set()
+    existing_names = {}
+    # Read the conversion log once; new entries are collected in memory and written back in one go
+    log_data = load_conversion_log(output_dir)
     for input_path in input_paths:
         if not os.path.exists(input_path):
             logger.error(f"Path {input_path} does not exist")
@@ -325,7 +453,7 @@ def main():
             debug_print(f"Created output directory: {output_subdir}")
 
             file_type = "video" if is_video else "image"
-            existing_output = get_existing_conversion(file_path, output_dir, prefix, file_type, duration=args.t)
+            existing_output = get_existing_conversion(log_data, file_path, file_type, duration=args.t)
             if existing_output and os.path.exists(existing_output):
                 logger.info(f"Skipping {file_path}: already converted to {existing_output}")
                 continue
@@ -334,22 +462,43 @@ def main():
                 logger.warning(f"Skipping {file_path}: source file does not exist")
                 continue
 
+            if (file_path, file_type) in queued:
+                continue
+            if output_subdir not in existing_names:
+                existing_names[output_subdir] = get_existing_names(output_subdir)
+            target_ratio = "9:16" if args.nine_sixteen else "1:1" if args.one_to_one else None
             if is_video and (not args.p or args.v):
-                name, output_path, video_count = get_next_available_name(output_subdir, prefix, "video", start_number=video_count, duration=args.t)
-                logger.info(f"Attempting to convert video: {file_path}")
-                success = convert_video(file_path, output_path, target_ratio="9:16" if args.nine_sixteen else "1:1" if args.one_to_one else None, duration=args.t)
-                if success:
-                    log_conversion(file_path, output_path, output_dir, duration=args.t)
-                if not success:
-                    logger.error(f"Failed to convert video: {file_path}")
+                name, output_path, video_count = get_next_available_name(output_subdir, prefix, "video", start_number=video_count, duration=args.t, existing=existing_names[output_subdir])
+                jobs.append((file_path, output_path, file_type, args.t, convert_video, (file_path, output_path, target_ratio, args.t)))
             elif not is_video and (not args.v or args.p):
-                name, output_path, image_count = get_next_available_name(output_subdir, prefix, "image", start_number=image_count, duration=None)
-                logger.info(f"Attempting to convert image: {file_path}")
-                success = convert_image(file_path, output_path, target_ratio="9:16" if args.nine_sixteen else "1:1" if args.one_to_one else None, crop=args.crop)
-                if success:
-                    log_conversion(file_path, output_path, output_dir, duration=None)
-                if not success:
-                    logger.error(f"Failed to convert image: {file_path}")
+                name, output_path, image_count = get_next_available_name(output_subdir, prefix, "image", start_number=image_count, duration=None, existing=existing_names[output_subdir])
+                jobs.append((file_path, output_path, file_type, None, convert_image, (file_path, output_path, target_ratio, args.crop)))
+            else:
+                continue
+            queued.add((file_path, file_type))
+
+    # Output names are fixed above, so the conversions themselves can run side by side
+    cpu_count = os.cpu_count() or 1
+    max_workers = max(1, cpu_count // 2)
+    # Split the cores between concurrent encodes so they do not each spawn a thread per core; a lone job keeps ffmpeg's default
+    threads = max(1, cpu_count // min(max_workers, len(jobs))) if len(jobs) > 1 else None
+    logged = len(log_data)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for file_path, output_path, file_type, duration, convert, convert_args in jobs:
+                logger.info(f"Attempting to convert {file_type}: {file_path}")
+                if convert is convert_video:
+                    convert_args = (*convert_args, threads)
+                futures.append(executor.submit(convert, *convert_args))
+            for (file_path, output_path, file_type, duration, _, _), future in zip(jobs, futures):
+                if future.result():
+                    log_conversion(log_data, file_path, output_path, duration=duration)
+                else:
+                    logger.error(f"Failed to convert {file_type}: {file_path}")
+    finally:
+        if len(log_data) > logged:
+            save_conversion_log(output_dir, log_data)
 
 if __name__ == "__main__":
     main()
@@ -1,115 +1,159 @@
-import subprocess
 import os
 import argparse
 import re
-import json
 import sys
 import shutil
-import time
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 
+try:
+    from yt_dlp import YoutubeDL
+    from yt_dlp.utils import download_range_func
+except ImportError:
+    YoutubeDL = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
+# Default number of URLs downloaded at once; kept low so sites do not rate-limit the batch
+MAX_WORKERS = 4
+CONCURRENT_FRAGMENTS = 4
+ARCHIVE_FILE = ".ytdlp_archive.txt"
+INVALID_CHARS_TABLE = str.maketrans(dict.fromkeys('<>:"/\\|?*', '_'))
+SHARE_ID_RE = re.compile(r'\?si=[^&]*')
+YOUTUBE_ID_RE = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})')
+naming_lock = threading.Lock()
+# YoutubeDL is not thread-safe, so each worker reuses its own instance across URLs
+downloader_state = threading.local()
+
 def check_dependencies():
     """Check if required tools are installed."""
-    for cmd in ["yt-dlp", "ffmpeg", "ffprobe"]:
+    if YoutubeDL is None:
+        logging.error("yt-dlp not found. Please install it (pip install yt-dlp).")
+        sys.exit(1)
+    for cmd in ["ffmpeg", "ffprobe"]:
         if not shutil.which(cmd):
             logging.error(f"{cmd} not found. Please install it.")
             sys.exit(1)
 
-def run_command(command, timeout=600):
-    """Execute a shell command with a timeout and print output in real-time."""
-    logging.debug(f"Executing: {command}")
-    try:
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
-        output_lines = []
-        for line in process.stdout:
-            print(line, end='')  # Print each line immediately to show progress
-            output_lines.append(line.strip())
-            logging.debug(line.strip())  # Log all output for verbose debugging
-        output = "\n".join(output_lines)
-        return True, output  # Assume success if output is captured, check title manually
-    except subprocess.TimeoutExpired:
-        logging.error(f"Command timed out after {timeout} seconds: {command}")
-        process.kill()
-        return False, "Timeout"
-    except Exception as e:
-        logging.error(f"Exception running command: {e}")
-        return False, str(e)
-
 def safe_remove(file_path):
     """Safely delete a file."""
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logging.debug(f"Deleted: {file_path}")
-    except Exception as e:
+        os.remove(file_path)
+        logging.debug(f"Deleted: {file_path}")
+    except FileNotFoundError:
+        pass
+    except OSError as e:
         logging.error(f"Error deleting {file_path}: {e}")
 
-def get_video_dimensions(video_path):
-    """Get video dimensions using ffprobe."""
-    cmd = f'ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of json "{video_path}"'
-    success, output = run_command(cmd)
-    if success:
-        try:
-            data = json.loads(output)
-            if data.get('streams'):
-                return data['streams'][0]['width'], data['streams'][0]['height']
-        except json.JSONDecodeError:
-            logging.error(f"Error parsing ffprobe output: {output}")
-    logging.warning(f"Using default 1920x1080 for {video_path}")
-    return 1920, 1080
+def remove_temp_files(output_dir, prefix):
+    """Delete every file in output_dir whose name starts with prefix, in one directory scan."""
+    try:
+        with os.scandir(output_dir) as entries:
+            temp_paths = [entry.path for entry in entries if entry.name.startswith(prefix) and entry.is_file()]
+    except OSError as e:
+        logging.error(f"Error scanning {output_dir}: {e}")
+        return
+    for temp_path in temp_paths:
+        safe_remove(temp_path)
 
 def sanitize_filename(filename):
     """Sanitize filename by removing invalid characters."""
-    invalid_chars = r'[<>:"/\\|?*]'
-    sanitized = re.sub(invalid_chars, '_', filename)
-    sanitized = re.sub(r'\s+', '_', sanitized.strip())
+    sanitized = '_'.join(filename.translate(INVALID_CHARS_TABLE).split())
     return sanitized[:200]
 
-def get_next_available_name(output_dir, media_ext, title, include_thumb=False):
+def get_existing_names(output_dir):
+    """Return the normalized names already in output_dir."""
+    try:
+        with os.scandir(output_dir) as entries:
+            return {os.path.normcase(entry.name) for entry in entries}
+    except OSError:
+        return set()
+
+def get_next_available_name(output_dir, media_ext, title, include_thumb=False, taken=None):
     """Generate unique filenames with title_trim_X pattern."""
+    if taken is None:
+        taken = get_existing_names(output_dir)
     sanitized_name = sanitize_filename(title if title else "Untitled")
     trim_number = 1
     while True:
         media_name = f"{sanitized_name}_trim_{trim_number}{media_ext}"
         thumb_name = f"{sanitized_name}_trim_{trim_number}_thumb.webp" if include_thumb else None
-        full_media_path = os.path.join(output_dir, media_name)
-        logging.debug(f"Checking if {full_media_path} exists")
-        if not os.path.exists(full_media_path):
+        if os.path.normcase(media_name) not in taken:
             logging.debug(f"Selected {media_name} as available")
             return media_name, thumb_name, trim_number + 1
         trim_number += 1
         logging.debug(f"File exists, incrementing to trim_{trim_number}")
 
-def run_yt_dlp(url, output_path, is_audio=False, start_time=0, duration=None, include_thumb=False):
-    """Run yt-dlp to download media with optional trimming and thumbnail."""
-    clean_url = re.sub(r'\?si=[^&]*', '', url)
-    cmd = f'yt-dlp "{clean_url}" -o "{output_path}" --geo-bypass --verbose'
+def build_ydl_opts(output_dir, is_audio=False, start_time=0, duration=None, include_thumb=False, debug=False, archive=False):
+    """Build yt-dlp options for downloading media with optional trimming and thumbnail."""
+    ydl_opts = {
+        'outtmpl': os.path.join(output_dir, 'temp_media_%(id)s.%(ext)s'),
+        'geo_bypass': True,
+        'overwrites': True,
+        'verbose': debug,
+        'writethumbnail': include_thumb,
+        # Fetch HLS/DASH fragments in parallel and write straight to the final temp name without .part files
+        'concurrent_fragment_downloads': CONCURRENT_FRAGMENTS,
+        'nopart': True,
+        'updatetime': False,
+    }
     if is_audio:
-        cmd += ' --extract-audio --audio-format m4a --audio-quality 192k --format bestaudio'
+        ydl_opts['format'] = 'bestaudio'
+        ydl_opts['postprocessors'] = [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'm4a', 'preferredquality': '192'}]
     else:
-        cmd += ' --format "bestvideo+bestaudio/best" --merge-output-format mp4'
+        ydl_opts['format'] = 'bestvideo+bestaudio/best'
+        ydl_opts['merge_output_format'] = 'mp4'
+    if archive:
+        # yt-dlp records each finished video id here and skips recorded ids on later runs
+        ydl_opts['download_archive'] = os.path.join(output_dir, ARCHIVE_FILE)
     if duration:
-        cmd += f' --postprocessor-args "ffmpeg:-ss {start_time} -t {duration}"'
-    if not include_thumb:
-        cmd += ' --no-write-thumbnail'
-    return run_command(cmd)
-
-def get_video_title(url):
-    """Get video title using yt-dlp."""
-    clean_url = re.sub(r'\?si=[^&]*', '', url)
-    cmd = f'yt-dlp "{clean_url}" --get-title --geo-bypass'
-    success, output = run_command(cmd)
-    if output:  # Check if output contains the title, regardless of success flag
-        for line in output.split('\n'):
-            line = line.strip()
-            if line and not line.startswith('['):
-                return line
-    logging.warning("Failed to retrieve title, using 'Untitled' as fallback")
-    return "Untitled"
+        # Only fetch the requested range; yt-dlp hands ffmpeg -ss before -i so it seeks instead of decoding up to the start
+        ydl_opts['download_ranges'] = download_range_func(None, [(start_time, start_time + duration)])
+    return ydl_opts
+
+def get_downloader(ydl_opts):
+    """Return this thread's YoutubeDL instance, creating it on first use."""
+    ydl = getattr(downloader_state, 'ydl', None)
+    if ydl is None:
+        ydl = downloader_state.ydl = YoutubeDL(ydl_opts)
+    return ydl
+
+def clean_url(url):
+    """Strip the share-tracking ?si= parameter that yt-dlp does not need."""
+    return SHARE_ID_RE.sub('', url)
+
+def url_key(url):
+    """Return the key used to drop duplicate URLs: the YouTube video id when present, else the cleaned URL."""
+    url = clean_url(url)
+    match = YOUTUBE_ID_RE.search(url)
+    return match.group(1) if match else url
+
+def run_yt_dlp(url, ydl_opts):
+    """Download media with yt-dlp and return its info dict."""
+    try:
+        return True, get_downloader(ydl_opts).extract_info(clean_url(url), download=True)
+    except Exception as e:
+        return False, str(e)
+
+def find_temp_files(output_dir, temp_prefix):
+    """Map extension to path for every temp file of one video, from a single directory scan."""
+    try:
+        with os.scandir(output_dir) as entries:
+            return {entry.name[len(temp_prefix) - 1:].lower(): entry.path
+                    for entry in entries if entry.name.startswith(temp_prefix) and entry.is_file()}
+    except OSError as e:
+        logging.error(f"Error scanning {output_dir}: {e}")
+        return {}
+
+def find_thumbnail(info, temp_files):
+    """Return the thumbnail yt-dlp wrote for this video, whatever its extension."""
+    temp_paths = set(temp_files.values())
+    for thumb in reversed(info.get('thumbnails') or []):
+        if thumb.get('filepath') in temp_paths:
+            return thumb['filepath']
+    return next((temp_files[ext] for ext in (".webp", ".jpg", ".png") if ext in temp_files), None)
 
 def time_to_seconds(time_str):
     """Convert HH:MM:SS or MM:SS format to seconds."""
@@ -120,6 +164,64 @@ def time_to_seconds(time_str):
         m, s = [float(x) for x in re.sub(r'^(\d+):(\d+)$', r'\1:\2', time_str).split(':')]
         return int(m * 60 + s)
 
+def process_url(url, index, total, output_dir, is_audio, include_thumb, ydl_opts, taken):
+    """Download one URL to a temp file and move it to its final name. Returns True on success."""
+    logging.info(f"\nProcessing {'audio' if is_audio else 'video'} {index + 1}/{total}: {url}")
+    media_ext = ".m4a" if is_audio else ".mp4"
+    temp_prefix = None
+    try:
+        success, info = run_yt_dlp(url, ydl_opts)
+        if not success:
+            logging.error(f"Failed to download: {url}")
+            logging.error(f"Output: {info}")
+            return False
+        if info is None:
+            logging.info(f"Skipped (already in download archive): {url}")
+            return True
+
+        # Temp names carry the video id, so concurrent downloads never share files
+        temp_media = os.path.join(output_dir, f"temp_media_{info.get('id')}")
+        temp_prefix = os.path.basename(temp_media) + "."
+        title = info.get('title') or "Untitled"
+        logging.debug(f"Title: {title}")
+
+        temp_files = find_temp_files(output_dir, temp_prefix)
+        media_file = next((temp_files[ext] for ext in (media_ext, ".webm", ".mkv") if ext in temp_files), None)
+        if not media_file:
+            if ydl_opts.get('download_archive') and get_downloader(ydl_opts).in_download_archive(info):
+                logging.info(f"Skipped (already in download archive): {url}")
+                return True
+            logging.error(f"No media file found for: {url}")
+            return False
+
+        # Claim the name under the lock so concurrent workers never pick the same trim number
+        with naming_lock:
+            output_name, thumb_name, _ = get_next_available_name(output_dir, media_ext, title, include_thumb, taken)
+            taken.update(os.path.normcase(name) for name in (output_name, thumb_name) if name)
+        output_path = os.path.join(output_dir, output_name)
+        thumb_path = os.path.join(output_dir, thumb_name) if thumb_name else None
+        try:
+            os.replace(media_file, output_path)
+            logging.info(f"Saved {'Audio' if is_audio else 'Video'}: {output_path}")
+        except OSError as e:
+            logging.error(f"Error moving {media_file} to {output_path}: {e}")
+            return False
+
+        thumb_file = find_thumbnail(info, temp_files) if thumb_path else None
+        if thumb_file:
+            # Keep whatever format the site served rather than converting it
+            thumb_path = os.path.splitext(thumb_path)[0] + os.path.splitext(thumb_file)[1]
+            try:
+                os.replace(thumb_file, thumb_path)
+                logging.info(f"Saved Thumbnail: {thumb_path}")
+            except OSError as e:
+                logging.error(f"Error moving thumbnail {thumb_file} to {thumb_path}: {e}")
+        return True
+    finally:
+        # Catches every leftover for this video (.part, .ytdl, format-split streams, thumbnails)
+        if temp_prefix:
+            remove_temp_files(output_dir, temp_prefix)
+
 def main():
     """Main function to download and process YouTube media."""
     parser = argparse.ArgumentParser(description="Download YouTube media from urls.txt")
@@ -127,12 +229,17 @@ def main():
     parser.add_argument("--start", type=str, default="0:00", help="Start time in HH:MM:SS or MM:SS format")
     parser.add_argument("--end", type=str, help="End time in HH:MM:SS or MM:SS format")
     parser.add_argument("--thumb", action="store_true", help="Include thumbnail in output")
+    parser.add_argument("--jobs", "-j", type=int, default=MAX_WORKERS, help=f"Number of URLs to download at once (default {MAX_WORKERS})")
+    parser.add_argument("--archive", action="store_true", help="Skip videos already downloaded into the output directory on earlier runs")
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
     parser.add_argument("--output-dir", "-o", default="./downloaded", help="Output directory")
     args = parser.parse_args()
 
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
+    if args.jobs < 1:
+        logging.error(f"--jobs must be at least 1, got {args.jobs}")
+        sys.exit(1)
 
     check_dependencies()
     is_audio = args.command == "audio"
@@ -143,79 +250,46 @@ def main():
     if not os.path.exists(url_file):
         logging.error(f"{url_file} not found.")
         sys.exit(1)
+    # Drop duplicates as they are read, keeping the first occurrence's order. Two links to the same
+    # video would download to the same temp_media_<id> files at once, so compare video ids, not raw URLs
+    unique_urls = []
+    seen = set()
     with open(url_file, "r", encoding='utf-8') as f:
-        urls = [url.strip() for line in f for url in line.split(";") if url.strip()]
-    if not urls:
+        for line in f:
+            for url in line.split(";"):
+                url = url.strip()
+                key = url_key(url)
+                if url and key not in seen:
+                    seen.add(key)
+                    unique_urls.append(url)
+    if not unique_urls:
         logging.error(f"{url_file} is empty.")
         sys.exit(1)
-    unique_urls = list(dict.fromkeys(urls))
-
-    current_number = 1
-
-    for index, url in enumerate(unique_urls):
-        logging.info(f"\nProcessing {'audio' if is_audio else 'video'} {index + 1}/{len(unique_urls)}: {url}")
-        shortcode = url.split('youtu.be/')[-1].split('?')[0]
-        temp_media = os.path.join(output_dir, f"temp_media_{shortcode}")
-        temp_files = [temp_media + ext for ext in [".m4a", ".mp4", ".webm", ".mkv", ".part", ".webp", ".jpg", ".jpeg", ".png"]]
-        for temp in temp_files:
-            safe_remove(temp)
-
-        media_ext = ".m4a" if is_audio else ".mp4"
-        title = get_video_title(url)
-        logging.debug(f"Initial title from output: {title}")
-        logging.debug(f"Final title before filename: {title}")
-        output_name, thumb_name, new_number = get_next_available_name(output_dir, media_ext, title, args.thumb)
-        output_path = os.path.join(output_dir, output_name)
-        thumb_path = os.path.join(output_dir, thumb_name) if thumb_name else None
 
-        # Convert start and end times to seconds
-        start_seconds = time_to_seconds(args.start)
-        end_seconds = time_to_seconds(args.end) if args.end else None
-        duration = end_seconds - start_seconds if end_seconds else None
+    # Convert start and end times to seconds
+    start_seconds = time_to_seconds(args.start)
+    end_seconds = time_to_seconds(args.end) if args.end else None
+    duration = end_seconds - start_seconds if end_seconds else None
 
-        if duration and duration <= 0:
-            logging.error(f"End time ({args.end}) must be after start time ({args.start})")
-            continue
-
-        success, output = run_yt_dlp(url, temp_media + ".%(ext)s", is_audio, start_seconds, duration, args.thumb)
-        if not success:
-            logging.error(f"Failed to download: {url}")
-            logging.error(f"Output: {output}")
-            continue
-
-        media_file = None
-        for ext in [".m4a" if is_audio else ".mp4", ".webm", ".mkv"]:
-            if os.path.exists(temp_media + ext):
-                media_file = temp_media + ext
-                break
-        if not media_file:
-            logging.error(f"No media file found for: {url}")
-            continue
-
-        # Move temp file to final output path
-        if os.path.exists(media_file):
-            try:
-                shutil.move(media_file, output_path)
-                logging.info(f"Saved {'Audio' if is_audio else 'Video'}: {output_path}")
-            except Exception as e:
-                logging.error(f"Error moving {media_file} to {output_path}: {e}")
-                continue
-        else:
-            logging.error(f"Media file {media_file} not created")
-            continue
-
-        if thumb_path and os.path.exists(temp_media + ".webp"):
-            thumb_file = temp_media + ".webp"
-            try:
-                shutil.move(thumb_file, thumb_path)
-                logging.info(f"Saved Thumbnail: {thumb_path}")
-            except Exception as e:
-                logging.error(f"Error moving thumbnail {thumb_file} to {thumb_path}: {e}")
-
-        for temp in temp_files:
-            safe_remove(temp)
+    if duration and duration <= 0:
+        logging.error(f"End time ({args.end}) must be after start time ({args.start})")
+        sys.exit(1)
+    ydl_opts = build_ydl_opts(output_dir, is_audio, start_seconds, duration, args.thumb, args.debug, args.archive)
+    # Clear temp files left behind by an interrupted earlier run
+    remove_temp_files(output_dir, "temp_media_")
+    # Scan the output folder once; claimed names are added as downloads finish
+    taken = get_existing_names(output_dir)
 
-        current_number = new_number
+    # Downloads and ffmpeg post-processing are mostly I/O and child processes, so threads overlap them
+    total = len(unique_urls)
+    with ThreadPoolExecutor(max_workers=min(args.jobs, total)) as executor:
+        futures = [
+            executor.submit(process_url, url, index, total, output_dir, is_audio, args.thumb, ydl_opts, taken)
+            for index, url in enumerate(unique_urls)
+        ]
+        results = [future.result() for future in as_completed(futures)]
+    if not all(results):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,14 @@
 import os
 import subprocess
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Encoder options per frame format; JPEG at -q:v 2 is visually lossless and far cheaper to write than PNG
+FORMAT_ARGS = {
+    'jpg': ['-q:v', '2'],
+    'png': [],
+    'bmp': [],
+}
 
 def create_output_subfolder(output_dir, video_filename):
     # Create a subfolder named after the video file (without extension)
@@ -9,7 +17,20 @@ def create_output_subfolder(output_dir, video_filename):
     os.makedirs(subfolder_path, exist_ok=True)
     return subfolder_path
 
-def extract_frames(input_dir, output_dir):
+def extract_one(input_video, output_subfolder, threads, image_format):
+    # FFmpeg command to extract all frames
+    ffmpeg_cmd = [
+        'ffmpeg',
+        '-i', input_video,
+        '-vf', 'fps=30',  # Adjust fps as needed
+        '-threads', str(threads),
+        *FORMAT_ARGS[image_format],
+        os.path.join(output_subfolder, f'frame_%04d.{image_format}')
+    ]
+    # Run FFmpeg command
+    subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+def extract_frames(input_dir, output_dir, image_format='jpg'):
     # Ensure input and output directories exist
     if not os.path.exists(input_dir):
         print(f"Input directory '{input_dir}' does not exist.")
@@ -20,24 +41,29 @@ def extract_frames(input_dir, output_dir):
     # Supported video file extensions
     video_extensions = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
 
-    # Iterate through all files in the input directory
+    # Collect all videos in the input directory
+    jobs = []
     for filename in os.listdir(input_dir):
         if filename.lower().endswith(video_extensions):
             input_video = os.path.join(input_dir, filename)
             output_subfolder = create_output_subfolder(output_dir, filename)
+            jobs.append((filename, input_video, output_subfolder))
+    if not jobs:
+        return
 
-            # FFmpeg command to extract all frames
-            ffmpeg_cmd = [
-                'ffmpeg',
-                '-i', input_video,
-                '-vf', 'fps=30',  # Adjust fps as needed
-                os.path.join(output_subfolder, 'frame_%04d.png')
-            ]
-
+    # ffmpeg is multithreaded itself, so run half as many videos as CPUs and split the threads between them
+    cpu_count = os.cpu_count() or 1
+    max_workers = max(1, min(cpu_count // 2, len(jobs)))
+    threads = max(1, cpu_count // max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for filename, input_video, output_subfolder in jobs:
+            print(f"Extracting frames from {filename} to {output_subfolder}")
+            futures[executor.submit(extract_one, input_video, output_subfolder, threads, image_format)] = filename
+        for future in as_completed(futures):
+            filename = futures[future]
             try:
-                # Run FFmpeg command
-                print(f"Extracting frames from {filename} to {output_subfolder}")
-                subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                future.result()
                 print(f"Finished extracting frames from {filename}")
             except subprocess.CalledProcessError as e:
                 print(f"Error processing {filename}: {e.stderr}")
@@ -49,12 +75,13 @@ def main():
     parser = argparse.ArgumentParser(description="Extract frames from all videos in a folder using FFmpeg.")
     parser.add_argument('input_dir', help="Path to the input folder containing video files")
     parser.add_argument('output_dir', help="Path to the output folder for extracted frames")
+    parser.add_argument('--format', choices=list(FORMAT_ARGS), default='jpg', help="Image format for extracted frames (default: jpg)")
     
     # Parse arguments
     args = parser.parse_args()
 
     # Run the extraction process
-    extract_frames(args.input_dir, args.output_dir)
+    extract_frames(args.input_dir, args.output_dir, args.format)
 
 if __name__ == "__main__":
     main()
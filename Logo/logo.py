@@ -4,9 +4,11 @@ import sys
 import argparse
 import json
 import logging
-import shutil
 import uuid
 import time
+import functools
+import shlex
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logging.basicConfig(
@@ -24,32 +26,39 @@ LOGO_FOLDER = os.path.join(SCRIPT_DIR, 'logo')
 
 def is_file_locked(file_path, retries=3, delay=4):
     """Check if a file is locked by attempting to open it."""
-    for attempt in range(retries):
+    # Only Windows refuses to open files another process is writing; elsewhere a failed open will not clear by waiting
+    attempts = retries if os.name == 'nt' else 1
+    for attempt in range(attempts):
         try:
             with open(file_path, 'a'):
                 return False
-        except (IOError, PermissionError, OSError):
-            time.sleep(delay)
-    logger.error(f"File {file_path} is locked after {retries} attempts")
+        except OSError:
+            if attempt + 1 < attempts:
+                time.sleep(delay)
+    logger.error(f"File {file_path} is locked after {attempts} attempts")
     return True
 
+@functools.lru_cache(maxsize=128)
+def probe_video(video_path, size, mtime_ns):
+    """Run ffprobe once per file version; size and mtime_ns key the cache."""
+    cmd = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', video_path]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+def get_probe(video_path):
+    """Return cached ffprobe output for a video, shared by the resolution and metadata lookups."""
+    st = os.stat(video_path)
+    return probe_video(video_path, st.st_size, st.st_mtime_ns)
+
 def get_video_resolution(video_path):
     """Retrieve the resolution of a video using ffprobe."""
     try:
-        cmd = [
-            'ffprobe',
-            '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height',
-            '-of', 'json',
-            video_path
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-        width = data['streams'][0]['width']
-        height = data['streams'][0]['height']
+        data = get_probe(video_path)
+        video_streams = [s for s in data['streams'] if s.get('codec_type') == 'video']
+        width = video_streams[0]['width']
+        height = video_streams[0]['height']
         return width, height
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, OSError) as e:
         logger.error(f"Error processing {video_path}: {e}")
         return None
     except (KeyError, IndexError, json.JSONDecodeError):
@@ -58,16 +67,8 @@ def get_video_resolution(video_path):
 
 def get_metadata(file_path):
     """Extract metadata from a video file using ffprobe."""
-    cmd = f'ffprobe -v quiet -print_format json -show_format -show_streams "{file_path}"'
     try:
-        result = subprocess.run(
-            cmd,
-            shell=True,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        metadata = json.loads(result.stdout)
+        metadata = get_probe(file_path)
         tags = metadata.get('format', {}).get('tags', {})
         return {
             'title': tags.get('title', os.path.basename(file_path)),
@@ -75,32 +76,37 @@ def get_metadata(file_path):
             'album': tags.get('album', ''),
             'duration': metadata.get('format', {}).get('duration', '')
         }, ""
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, OSError) as e:
         return {}, f"FFprobe error: {str(e)}"
     except json.JSONDecodeError:
         return {}, "Failed to parse metadata JSON"
 
+def build_overlay_command(src_path, logo_path, dest_path, x_offset, y_offset, metadata_dict=None):
+    """Build the ffmpeg argv that overlays the logo, optionally tagging the output with metadata."""
+    metadata_args = []
+    for key, value in (metadata_dict or {}).items():
+        if value:
+            metadata_args += ['-metadata', f'{key}={value}']
+    return [
+        'ffmpeg', '-i', src_path, '-i', logo_path,
+        '-filter_complex', f'overlay=main_w-overlay_w-{x_offset}:main_h-overlay_h-{y_offset}',
+        '-c:v', 'libx264', '-c:a', 'copy', '-f', 'mp4', '-y', *metadata_args, dest_path
+    ]
+
 def apply_metadata(src_path, logo_path, dest_path, metadata_dict, x_offset, y_offset):
     """Apply metadata and watermark to the output video using ffmpeg."""
     temp_output = dest_path + f".temp_{uuid.uuid4().hex[:12]}.tmp"
-    metadata_args = []
-    for key, value in metadata_dict.items():
-        if value:
-            metadata_args.append(f'-metadata {key}="{value.replace('"', '')}"')
-    metadata_cmd = " ".join(metadata_args) if metadata_args else ""
-    cmd = (
-        f'ffmpeg -i "{src_path}" -i "{logo_path}" '
-        f'-filter_complex "overlay=main_w-overlay_w-{x_offset}:main_h-overlay_h-{y_offset}" '
-        f'-c:v libx264 -c:a copy -f mp4 -y {metadata_cmd} "{temp_output}"'
-    )
+    cmd = build_overlay_command(src_path, logo_path, temp_output, x_offset, y_offset, metadata_dict)
     try:
-        subprocess.run(cmd, shell=True, check=True)
+        subprocess.run(cmd, check=True)
         if os.path.exists(temp_output):
-            shutil.move(temp_output, dest_path)
+            os.replace(temp_output, dest_path)
             return True, ""
         return False, "Failed to move temp file"
     except subprocess.CalledProcessError as e:
         return False, f"FFmpeg error: {str(e)}"
+    except OSError as e:
+        return False, f"Failed to move temp file: {str(e)}"
 
 def process_videos_in_folder(folder_path, prefix, logo_file, x_offset, y_offset, metadata=False, skipped=False):
     """Process all .mp4 files in the folder, applying a watermark and saving to a subfolder."""
@@ -128,15 +134,22 @@ def process_videos_in_folder(folder_path, prefix, logo_file, x_offset, y_offset,
     skipped_files = []
     processed_files = []
 
+    # ffprobe runs are independent per file, so probe the whole folder in parallel before the serial encodes
+    videos = sorted(videos, key=lambda x: x.lower())
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        resolutions = dict(zip(videos, executor.map(
+            lambda v: get_video_resolution(os.path.join(abs_folder_path, v)), videos
+        )))
+
     logger.info(f"Found .mp4 videos in {abs_folder_path}:")
-    for video in sorted(videos, key=lambda x: x.lower()):
+    for video in videos:
         video_path = os.path.join(abs_folder_path, video)
         if is_file_locked(video_path):
             skipped_files.append((video, video_path, "File is locked"))
             logger.error(f"Skipped {video}: File is locked")
             continue
 
-        resolution = get_video_resolution(video_path)
+        resolution = resolutions[video]
         if not resolution:
             skipped_files.append((video, video_path, "Could not extract resolution"))
             continue
@@ -162,12 +175,8 @@ def process_videos_in_folder(folder_path, prefix, logo_file, x_offset, y_offset,
                 skipped_files.append((video, video_path, f"Metadata extraction error: {meta_error}"))
 
         # FFmpeg command to apply watermark
-        ffmpeg_cmd = (
-            f'ffmpeg -i "{video_path}" -i "{logo_path}" '
-            f'-filter_complex "overlay=main_w-overlay_w-{x_offset}:main_h-overlay_h-{y_offset}" '
-            f'-c:v libx264 -c:a copy -f mp4 "{output_video}"'
-        )
-        logger.info(f"FFmpeg command:\n```{ffmpeg_cmd}```")
+        ffmpeg_cmd = build_overlay_command(video_path, logo_path, output_video, x_offset, y_offset)
+        logger.info(f"FFmpeg command:\n```{shlex.join(ffmpeg_cmd)}```")
 
         # Execute FFmpeg command or apply metadata
         try:
@@ -175,12 +184,12 @@ def process_videos_in_folder(folder_path, prefix, logo_file, x_offset, y_offset,
                 success, error = apply_metadata(video_path, logo_path, output_video, metadata_dict, x_offset, y_offset)
                 if not success:
                     logger.warning(f"Metadata application failed for {video}: {error}, proceeding without metadata")
-                    subprocess.run(ffmpeg_cmd, shell=True, check=True)
+                    subprocess.run(ffmpeg_cmd, check=True)
             else:
-                subprocess.run(ffmpeg_cmd, shell=True, check=True)
+                subprocess.run(ffmpeg_cmd, check=True)
             logger.info(f"Successfully created {output_video}")
             processed_files.append((video, output_video))
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, OSError) as e:
             logger.error(f"Error executing FFmpeg for {video}: {e}")
             skipped_files.append((video, video_path, f"FFmpeg error: {str(e)}"))
 
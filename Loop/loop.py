@@ -2,42 +2,63 @@ import subprocess
 import sys
 import os
 import argparse
+import re
 import time
+import threading
+from collections import deque
+import json
 import shutil
+import tempfile
 
 DEBUG = False
+STDERR_TAIL_LINES = 64
+INVALID_CHARS_RE = re.compile(r'[<>:"/\\|?*]')
+SHM_DIR = '/dev/shm'
 
 def debug_print(*args, **kwargs):
     if DEBUG:
         print(*args, **kwargs)
 
-def run_command(command, suppress_errors=False, timeout=None, retries=1):
+def pick_temp_root(input_path):
+    # Keep the intermediate trim in RAM only when the tmpfs has room for it; Docker's default /dev/shm is 64 MB.
+    # Twice the input size leaves headroom for audio re-encoded to AAC at a higher bitrate than the source
+    if not os.path.ismount(SHM_DIR):
+        return None
+    try:
+        if shutil.disk_usage(SHM_DIR).free > 2 * os.path.getsize(input_path):
+            return SHM_DIR
+    except OSError:
+        pass
+    return None
+
+def wait_with_stderr_tail(process, timeout=None):
+    # Only the last lines matter when reporting a failed trim or loop, so drop the rest as it arrives
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    reader = threading.Thread(target=lambda: tail.extend(process.stderr), daemon=True)
+    reader.start()
+    return_code = process.wait(timeout=timeout)
+    reader.join()
+    return return_code, ''.join(tail)
+
+def run_command(command, suppress_errors=False, timeout=None, retries=1, capture_stdout=True):
+    stream_stderr = not capture_stdout and not DEBUG and not suppress_errors
     attempt = 0
     while attempt <= retries:
         debug_print(f"Running command (Attempt {attempt+1}/{retries+1}): {command}")
         stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
         stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
-        output, errors = [], []
         try:
-            stdout_data, stderr_data = process.communicate(timeout=timeout)
-            if stdout_data:
-                debug_print(stdout_data, end='')
-                output.append(stdout_data)
-            if stderr_data:
-                debug_print(stderr_data, end='')
-                errors.append(stderr_data)
-            return_code = process.returncode
-            output_str = ''.join(output)
-            error_str = ''.join(errors)
-            debug_print(f"Command finished: return_code={return_code}")
-            if return_code != 0:
-                if not suppress_errors:
-                    debug_print(f"Error: return_code={return_code}. Output: {output_str}\nErrors: {error_str}")
-                return False, output_str + "\n" + error_str
-            return True, output_str
+            if stream_stderr:
+                process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+                try:
+                    return_code, error_str = wait_with_stderr_tail(process, timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    raise
+                result = subprocess.CompletedProcess(command, return_code, "", error_str)
+            else:
+                result = subprocess.run(command, stdout=stdout, stderr=stderr, text=True, timeout=timeout)
         except subprocess.TimeoutExpired:
-            process.kill()
             attempt += 1
             if attempt <= retries:
                 debug_print(f"Timeout after {timeout}s. Retrying {attempt}/{retries}")
@@ -45,17 +66,24 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
                 continue
             debug_print(f"Timeout after {timeout}s. No more retries")
             return False, f"Timeout after {timeout}s"
-        except Exception as ex:
-            process.kill()
+        except OSError as ex:
             debug_print(f"Error: {ex}")
             return False, str(ex)
-        finally:
-            if process.poll() is None:
-                process.terminate()
+        output_str = result.stdout or ""
+        error_str = result.stderr or ""
+        if output_str:
+            debug_print(output_str, end='')
+        if error_str:
+            debug_print(error_str, end='')
+        debug_print(f"Command finished: return_code={result.returncode}")
+        if result.returncode != 0:
+            if not suppress_errors:
+                debug_print(f"Error: return_code={result.returncode}. Output: {output_str}\nErrors: {error_str}")
+            return False, output_str + "\n" + error_str
+        return True, output_str
 
 def sanitize_filename(filename):
-    invalid_chars = r'[<>:"/\\|?*]'
-    sanitized = re.sub(invalid_chars, '', filename.strip()).strip('[]{}()').rstrip('.').lstrip('._')[:200]
+    sanitized = INVALID_CHARS_RE.sub('', filename.strip()).strip('[]{}()').rstrip('.').lstrip('._')[:200]
     return sanitized or '_'
 
 def get_next_available_name(output_dir, prefix, extension, suffix="", title=None, start_number=1):
@@ -72,25 +100,38 @@ def get_next_available_name(output_dir, prefix, extension, suffix="", title=None
             return name, full_path, number + 1
         number += 1
 
-def get_file_duration(file_path):
-    command = f'ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{file_path}"'
+def silent_remove(file_path):
+    try:
+        os.remove(file_path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def get_file_info(file_path):
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration:stream=codec_type,codec_name', '-of', 'json', file_path]
     debug_print(f"Running ffprobe: {command}")
     success, output = run_command(command)
     if not success:
         debug_print(f"ffprobe failed: {output}")
-        return 0
-    output = output.strip()
-    debug_print(f"Duration output: '{output}'")
+        return 0, None
+    try:
+        info = json.loads(output)
+    except json.JSONDecodeError:
+        print(f"Warning: Invalid ffprobe output for {file_path}")
+        return 0, None
+    audio_codec = next((s.get('codec_name') for s in info.get('streams', []) if s.get('codec_type') == 'audio'), None)
+    output = str(info.get('format', {}).get('duration', ''))
+    debug_print(f"Duration output: '{output}', audio codec: {audio_codec}")
     if not output:
         print(f"Warning: Empty duration for {file_path}")
-        return 0
+        return 0, audio_codec
     try:
         duration = float(output)
         debug_print(f"Duration: {duration}s")
-        return duration
+        return duration, audio_codec
     except ValueError:
         print(f"Warning: Invalid duration for {file_path}: '{output}'")
-        return 0
+        return 0, audio_codec
 
 def find_video_file(video_path, base_dir=None):
     extensions = ['.mp4', '.mkv']
@@ -170,7 +211,7 @@ def main():
         sys.exit(1)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    file_duration = get_file_duration(actual_input)
+    file_duration, audio_codec = get_file_info(actual_input)
     if file_duration == 0:
         print(f"Error: Could not get duration for {actual_input}")
         sys.exit(1)
@@ -185,22 +226,22 @@ def main():
     prefix = "AL" if output_type == "a" else "VL"
     extension = ".m4a" if output_type == "a" else ".mp4"
     name, output_path, _ = get_next_available_name(output_dir, prefix, extension)
-    temp_dir = os.path.abspath(os.path.join(".", "temp"))
+    temp_dir = tempfile.mkdtemp(prefix="loop_", dir=pick_temp_root(actual_input))
     temp_path = os.path.join(temp_dir, "temp_file")
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
+    # AAC sources are copied like the video stream; anything else is encoded to AAC for the mp4/m4a output
+    audio_args = ['-c:a', 'copy'] if audio_codec == "aac" else ['-c:a', 'aac', '-b:a', '128k']
     try:
         if output_type == "v":
-            ffmpeg_command = (
-                f'ffmpeg -y -i "{actual_input}" -ss {start_time} -t {trim_duration} '
-                f'-c:v copy -c:a aac -b:a 128k "{temp_path}{extension}"'
-            )
+            ffmpeg_command = [
+                'ffmpeg', '-y', '-i', actual_input, '-ss', str(start_time), '-t', str(trim_duration),
+                '-c:v', 'copy', *audio_args, f"{temp_path}{extension}"
+            ]
         else:
-            ffmpeg_command = (
-                f'ffmpeg -y -i "{actual_input}" -vn -ss {start_time} -t {trim_duration} '
-                f'-c:a aac -b:a 128k "{temp_path}{extension}"'
-            )
-        success, output = run_command(ffmpeg_command)
+            ffmpeg_command = [
+                'ffmpeg', '-y', '-i', actual_input, '-vn', '-ss', str(start_time), '-t', str(trim_duration),
+                *audio_args, f"{temp_path}{extension}"
+            ]
+        success, output = run_command(ffmpeg_command, capture_stdout=False)
         if not success or not os.path.exists(f"{temp_path}{extension}"):
             print(f"Trim failed for {actual_input}: {output}")
             sys.exit(1)
@@ -208,25 +249,25 @@ def main():
             loop_duration = duration
             if loop_duration <= trim_duration:
                 print(f"Warning: Duration {loop_duration} <= trim duration {trim_duration}. No looping")
-                os.rename(f"{temp_path}{extension}", output_path)
+                shutil.move(f"{temp_path}{extension}", output_path)
                 print(f"Saved {'audio' if output_type == 'a' else 'video'} as {output_path.replace(os.sep, '/')}")
             else:
                 loop_count = int(loop_duration // trim_duration) + (1 if loop_duration % trim_duration > 0 else 0)
                 final_duration = min(loop_duration, loop_count * trim_duration)
-                ffmpeg_command = (
-                    f'ffmpeg -y -stream_loop {loop_count-1} -i "{temp_path}{extension}" '
-                    f'-c:{"v copy" if output_type == "v" else "a copy"} -t {final_duration} "{output_path}"'
-                )
-                success, output = run_command(ffmpeg_command)
+                # The trim already holds AAC audio, so copy every stream rather than encoding the audio a second time
+                ffmpeg_command = [
+                    'ffmpeg', '-y', '-stream_loop', str(loop_count - 1), '-i', f"{temp_path}{extension}",
+                    '-c', 'copy', '-t', str(final_duration), output_path
+                ]
+                success, output = run_command(ffmpeg_command, capture_stdout=False)
                 if success:
                     print(f"Saved {'audio' if output_type == 'a' else 'video'} as {output_path.replace(os.sep, '/')}")
                 else:
                     print(f"Loop failed for {actual_input}: {output}")
                     sys.exit(1)
-                if os.path.exists(f"{temp_path}{extension}"):
-                    os.remove(f"{temp_path}{extension}")
+                silent_remove(f"{temp_path}{extension}")
         else:
-            os.rename(f"{temp_path}{extension}", output_path)
+            shutil.move(f"{temp_path}{extension}", output_path)
             print(f"Saved {'audio' if output_type == 'a' else 'video'} as {output_path.replace(os.sep, '/')}")
     finally:
         if os.path.exists(temp_dir):
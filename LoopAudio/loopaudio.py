@@ -3,6 +3,7 @@ import sys
 import os
 import argparse
 import time
+import json
 
 DEBUG = False
 
@@ -16,27 +17,9 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
         debug_print(f"Running command (Attempt {attempt+1}/{retries+1}): {command}")
         stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
         stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
-        output, errors = [], []
         try:
-            stdout_data, stderr_data = process.communicate(timeout=timeout)
-            if stdout_data:
-                debug_print(stdout_data, end='')
-                output.append(stdout_data)
-            if stderr_data:
-                debug_print(stderr_data, end='')
-                errors.append(stderr_data)
-            return_code = process.returncode
-            output_str = ''.join(output)
-            error_str = ''.join(errors)
-            debug_print(f"Command finished: return_code={return_code}")
-            if return_code != 0:
-                if not suppress_errors:
-                    debug_print(f"Error: return_code={return_code}. Output: {output_str}\nErrors: {error_str}")
-                return False, output_str + "\n" + error_str
-            return True, output_str
+            result = subprocess.run(command, stdout=stdout, stderr=stderr, text=True, timeout=timeout)
         except subprocess.TimeoutExpired:
-            process.kill()
             attempt += 1
             if attempt <= retries:
                 debug_print(f"Timeout after {timeout}s. Retrying {attempt}/{retries}")
@@ -44,13 +27,21 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
                 continue
             debug_print(f"Timeout after {timeout}s. No more retries")
             return False, f"Timeout after {timeout}s"
-        except Exception as ex:
-            process.kill()
+        except OSError as ex:
             debug_print(f"Error: {ex}")
             return False, str(ex)
-        finally:
-            if process.poll() is None:
-                process.terminate()
+        output_str = result.stdout or ""
+        error_str = result.stderr or ""
+        if output_str:
+            debug_print(output_str, end='')
+        if error_str:
+            debug_print(error_str, end='')
+        debug_print(f"Command finished: return_code={result.returncode}")
+        if result.returncode != 0:
+            if not suppress_errors:
+                debug_print(f"Error: return_code={result.returncode}. Output: {output_str}\nErrors: {error_str}")
+            return False, output_str + "\n" + error_str
+        return True, output_str
 
 def get_next_available_name(output_dir, prefix, extension, start_number=1):
     number = start_number
@@ -61,25 +52,31 @@ def get_next_available_name(output_dir, prefix, extension, start_number=1):
             return name, full_path, number + 1
         number += 1
 
-def get_file_duration(file_path):
-    command = f'ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{file_path}"'
+def get_file_info(file_path):
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration:stream=codec_type,codec_name', '-of', 'json', file_path]
     debug_print(f"Running ffprobe: {command}")
     success, output = run_command(command)
     if not success:
         debug_print(f"ffprobe failed: {output}")
-        return 0
-    output = output.strip()
-    debug_print(f"Duration output: '{output}'")
+        return 0, None
+    try:
+        info = json.loads(output)
+    except json.JSONDecodeError:
+        print(f"Warning: Invalid ffprobe output for {file_path}")
+        return 0, None
+    audio_codec = next((s.get('codec_name') for s in info.get('streams', []) if s.get('codec_type') == 'audio'), None)
+    output = str(info.get('format', {}).get('duration', ''))
+    debug_print(f"Duration output: '{output}', audio codec: {audio_codec}")
     if not output:
         print(f"Warning: Empty duration for {file_path}")
-        return 0
+        return 0, audio_codec
     try:
         duration = float(output)
         debug_print(f"Duration: {duration}s")
-        return duration
+        return duration, audio_codec
     except ValueError:
         print(f"Warning: Invalid duration for {file_path}: '{output}'")
-        return 0
+        return 0, audio_codec
 
 def find_audio_file(input_path):
     extensions = ['.m4a', '.mp3', '.wav', '.aac']
@@ -119,7 +116,7 @@ def main():
         sys.exit(1)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    audio_duration = get_file_duration(actual_audio)
+    audio_duration, audio_codec = get_file_info(actual_audio)
     if audio_duration == 0:
         print(f"Error: Could not get duration for {actual_audio}")
         sys.exit(1)
@@ -130,10 +127,12 @@ def main():
         loop_count = int(duration // audio_duration) + (1 if duration % audio_duration > 0 else 0)
         final_duration = min(duration, loop_count * audio_duration)
     name, output_path, _ = get_next_available_name(output_dir, "A", ".m4a")
-    ffmpeg_command = (
-        f'ffmpeg -y -stream_loop {loop_count-1} -i "{actual_audio}" '
-        f'-c:a aac -b:a 128k -t {final_duration} "{output_path}"'
-    )
+    # AAC already fits the .m4a output, so loop the packets as-is instead of re-encoding
+    audio_args = ['-c:a', 'copy'] if audio_codec == "aac" else ['-c:a', 'aac', '-b:a', '128k']
+    ffmpeg_command = [
+        'ffmpeg', '-y', '-stream_loop', str(loop_count - 1), '-i', actual_audio,
+        *audio_args, '-t', str(final_duration), output_path
+    ]
     success, output = run_command(ffmpeg_command)
     if success:
         print(f"Saved audio as {output_path.replace(os.sep, '/')}")
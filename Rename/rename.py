@@ -9,6 +9,8 @@ import shutil
 import uuid
 import hashlib
 import time
+import sqlite3
+import stat
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,6 +23,10 @@ logger = logging.getLogger(__name__)
 # Define supported extensions
 PICTURE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'}
 VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.mpeg', '.mpg'}
+INVALID_CHARS_RE = re.compile(r'[<>:"/\\|?*;\x00-\x1F]')
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "yt_tools", "rename_meta.sqlite")
+CACHE_COMMIT_INTERVAL = 100
+SYSTEM_FILES = {'desktop.ini', 'thumbs.db'}
 
 def check_dependencies():
     """Check if ffmpeg and ffprobe are installed."""
@@ -39,8 +45,7 @@ def is_file_locked(file_path, retries=3, delay=4):
     return True
 
 def sanitize_filename(filename):
-    invalid_chars = r'[<>:"/\\|?*;\x00-\x1F]'
-    sanitized = re.sub(invalid_chars, '_', filename)
+    sanitized = INVALID_CHARS_RE.sub('_', filename)
     max_length = 100
     if len(sanitized) > max_length:
         sanitized = sanitized[:max_length]
@@ -60,7 +65,6 @@ def run_command(command, timeout=15):
     try:
         process = subprocess.Popen(
             command,
-            shell=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True
@@ -76,12 +80,67 @@ def run_command(command, timeout=15):
         except:
             pass
 
-def get_metadata(file_path):
-    cmd = f'ffprobe -v quiet -print_format json -show_format -show_streams "{file_path}"'
-    stdout, stderr = run_command(cmd)
+def open_metadata_cache(folder_path):
+    """Open the per-user ffprobe cache and drop rows for files under folder_path that no longer exist."""
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        db = sqlite3.connect(CACHE_PATH)
+        db.execute('CREATE TABLE IF NOT EXISTS meta(path TEXT PRIMARY KEY, mtime INT, size INT, json TEXT)')
+        folder_prefix = os.path.join(os.path.abspath(folder_path), '')
+        rows = db.execute('SELECT path FROM meta WHERE substr(path, 1, ?) = ?', (len(folder_prefix), folder_prefix))
+        missing = [(path,) for (path,) in rows.fetchall() if not os.path.exists(path)]
+        if missing:
+            db.executemany('DELETE FROM meta WHERE path=?', missing)
+        return db
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Metadata cache unavailable: {str(e)}")
+        return None
+
+def close_metadata_cache(db):
+    if db is None:
+        return
+    try:
+        db.commit()
+        db.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Failed to save metadata cache: {str(e)}")
+
+def get_cached_probe(db, key):
+    if db is None:
+        return None
+    try:
+        row = db.execute('SELECT json FROM meta WHERE path=? AND mtime=? AND size=?', key).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+
+def store_cached_probe(db, key, stdout):
+    if db is None:
+        return
+    try:
+        db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?)', (*key, stdout))
+        if db.total_changes % CACHE_COMMIT_INTERVAL == 0:
+            db.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"Failed to cache metadata: {str(e)}")
+
+def get_metadata(file_path, db=None):
+    key = None
+    stdout = None
+    if db is not None:
+        st = os.stat(file_path)
+        key = (os.path.abspath(file_path), st.st_mtime_ns, st.st_size)
+        stdout = get_cached_probe(db, key)
+    cached = stdout is not None
+    stderr = ""
+    if not cached:
+        cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', file_path]
+        stdout, stderr = run_command(cmd)
     if stdout:
         try:
             metadata = json.loads(stdout)
+            if key is not None and not cached:
+                store_cached_probe(db, key, stdout)
             tags = metadata.get('format', {}).get('tags', {})
             return {
                 'title': tags.get('title', os.path.basename(file_path)),
@@ -95,21 +154,17 @@ def get_metadata(file_path):
 
 def apply_metadata(src_path, dest_path, metadata_dict):
     temp_output = dest_path + f".temp_{uuid.uuid4().hex[:12]}.tmp"
-    metadata_args = []
+    cmd = ['ffmpeg', '-i', src_path, '-c', 'copy', '-map', '0', '-y']
     for key, value in metadata_dict.items():
         if value:
-            metadata_args.append(f'-metadata {key}="{value.replace('"', '')}"')
-    metadata_cmd = " ".join(metadata_args) if metadata_args else ""
-    cmd = (
-        f'ffmpeg -i "{src_path}" -c copy -map 0 -y '
-        f'{metadata_cmd} "{temp_output}"'
-    )
+            cmd += ['-metadata', f'{key}={value}']
+    cmd.append(temp_output)
     _, stderr = run_command(cmd, timeout=30)
     if os.path.exists(temp_output):
         try:
-            shutil.move(temp_output, dest_path)
+            os.replace(temp_output, dest_path)
             return True, ""
-        except Exception as e:
+        except OSError as e:
             return False, f"Failed to move temp: {str(e)}"
     return False, stderr or "Failed to apply metadata"
 
@@ -150,7 +205,7 @@ def move_or_copy_file(src, dest, metadata_dict=None, apply_metadata_flag=False,
             time.sleep(delay)
     raise IOError(f"Unable to {'copy' if copy_flag else 'move'} after {retries} attempts: {src}")
 
-def process_files(folder_path, prefix, skipped, metadata, flatten_to_folder, copy_flag):
+def process_files(folder_path, prefix, skipped, metadata, flatten_to_folder, copy_flag, db=None):
     abs_folder_path = os.path.abspath(folder_path).replace('/', os.sep)
     if not os.path.isdir(abs_folder_path):
         logger.error(f"'{abs_folder_path}' is not a directory.")
@@ -158,6 +213,7 @@ def process_files(folder_path, prefix, skipped, metadata, flatten_to_folder, cop
 
     skipped_files = []
     processed_files = []
+    visited_dirs = []
 
     # Create target folders
     pictures_folder = os.path.join(abs_folder_path, f"{sanitize_filename(prefix)}_Pictures") if flatten_to_folder else None
@@ -174,19 +230,24 @@ def process_files(folder_path, prefix, skipped, metadata, flatten_to_folder, cop
 
     for root, dirs, files in os.walk(abs_folder_path):
         logger.info(f"Processing folder: {root}")
+        visited_dirs.append(root)
         # Skip target folders to avoid recursion
         if flatten_to_folder and any(os.path.abspath(root) == os.path.abspath(f) for f in [pictures_folder, videos_folder, other_folder] if f):
             logger.info(f"Skipping target folder: {root}")
             continue
         for filename in sorted(files, key=lambda x: x.lower()):
-            if filename.lower() in {'desktop.ini', 'thumbs.db'}:
+            if filename.lower() in SYSTEM_FILES:
                 logger.info(f"Skipped system file: {filename}")
                 continue
             full_path = os.path.join(root, filename)
-            if not os.path.isfile(full_path):
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
                 continue
             if is_file_locked(full_path):
-                skipped_files.append((filename, full_path, "File is locked"))
+                skipped_files.append((filename, full_path, "File is locked", st.st_size))
                 logger.error(f"Skipped {filename}: File is locked")
                 continue
 
@@ -207,10 +268,10 @@ def process_files(folder_path, prefix, skipped, metadata, flatten_to_folder, cop
             try:
                 metadata_dict = {}
                 if metadata:
-                    metadata_dict, meta_error = get_metadata(full_path)
+                    metadata_dict, meta_error = get_metadata(full_path, db)
                     if meta_error:
                         logger.warning(f"Metadata extraction failed for {filename}: {meta_error}")
-                        skipped_files.append((filename, full_path, f"Metadata extraction error: {meta_error}"))
+                        skipped_files.append((filename, full_path, f"Metadata extraction error: {meta_error}", st.st_size))
 
                 final_path = move_or_copy_file(
                     full_path,
@@ -223,7 +284,7 @@ def process_files(folder_path, prefix, skipped, metadata, flatten_to_folder, cop
                 logger.info(f"{'Copied' if copy_flag else 'Renamed'} {filename} to {os.path.basename(final_path)}")
 
             except Exception as e:
-                skipped_files.append((filename, full_path, f"{'Copy' if copy_flag else 'Rename'} error: {str(e)}"))
+                skipped_files.append((filename, full_path, f"{'Copy' if copy_flag else 'Rename'} error: {str(e)}", st.st_size))
                 logger.error(f"Skipped {filename}: {str(e)}")
 
     if skipped and skipped_files:
@@ -232,26 +293,23 @@ def process_files(folder_path, prefix, skipped, metadata, flatten_to_folder, cop
             with open(skipped_report_file, 'w', encoding='utf-8') as f:
                 f.write("Skipped files:\n")
                 total_size = 0
-                for orig_name, path, reason in sorted(skipped_files, key=lambda x: x[0].lower()):
+                for orig_name, path, reason, size_bytes in sorted(skipped_files, key=lambda x: x[0].lower()):
                     f.write(f"{orig_name} at {path}: {reason}\n")
-                    if os.path.exists(path):
-                        size = os.path.getsize(path) / (1024 ** 2)
-                        total_size += size
-                        f.write(f"  Size: {size:.2f} MB\n")
-                    else:
-                        f.write("  Size: File not found\n")
+                    size = size_bytes / (1024 ** 2)
+                    total_size += size
+                    f.write(f"  Size: {size:.2f} MB\n")
                 f.write(f"Total skipped size: {total_size:.2f} MB\n")
             logger.info(f"Skip report generated at {skipped_report_file}")
         except Exception as e:
             logger.error(f"Failed to write skipped report: {str(e)}")
 
-    for root, dirs, files in os.walk(abs_folder_path, topdown=False):
-        if not dirs and not files:
-            try:
-                os.rmdir(root)
-                logger.info(f"Removed empty folder: {root}")
-            except Exception as e:
-                logger.error(f"Failed to remove folder {root}: {str(e)}")
+    # Deepest folders first so parents emptied by the move can go too
+    for folder in sorted(set(visited_dirs), key=lambda p: -p.count(os.sep)):
+        try:
+            os.rmdir(folder)
+            logger.info(f"Removed empty folder: {folder}")
+        except OSError:
+            pass
 
     logger.info(f"Processed {len(processed_files)} files")
 
@@ -274,14 +332,22 @@ def main():
     if args.metadata:
         check_dependencies()
 
-    process_files(
-        folder_path=args.folder_path,
-        prefix=args.prefix,
-        skipped=args.skipped,
-        metadata=args.metadata,
-        flatten_to_folder=args.folder,
-        copy_flag=args.copy
-    )
+    # Reuse ffprobe results from earlier runs over the same folder. Only --copy leaves the sources at
+    # the paths the cache is keyed on; a move renames them away, so the cache could never hit
+    use_cache = args.metadata and args.copy and os.path.isdir(args.folder_path)
+    db = open_metadata_cache(args.folder_path) if use_cache else None
+    try:
+        process_files(
+            folder_path=args.folder_path,
+            prefix=args.prefix,
+            skipped=args.skipped,
+            metadata=args.metadata,
+            flatten_to_folder=args.folder,
+            copy_flag=args.copy,
+            db=db
+        )
+    finally:
+        close_metadata_cache(db)
 
 if __name__ == "__main__":
     main()
@@ -5,34 +5,64 @@ import argparse
 import glob
 import re
 import time
+import threading
+from collections import deque
 from PIL import Image
 import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
 
 DEBUG = False
+NUMBER_RE = re.compile(r'(\d+)')
+TARGET_RESOLUTIONS = {'landscape': (1920, 1080), 'portrait': (1080, 1920), 'square': (1080, 1080)}
+SOFTWARE_ENCODER_ARGS = ['-c:v', 'libx264', '-preset', 'fast']
+HARDWARE_ENCODER_ARGS = {
+    'h264_nvenc': ['-c:v', 'h264_nvenc', '-preset', 'p4'],
+    'h264_qsv': ['-c:v', 'h264_qsv', '-preset', 'fast'],
+    'h264_amf': ['-c:v', 'h264_amf', '-quality', 'speed'],
+}
+_encoder_args = None
+STDERR_TAIL_LINES = 64
 
 def debug_print(*args, **kwargs):
     if DEBUG:
         print(*args, **kwargs)
 
-def run_command(command, suppress_errors=False, timeout=None, retries=1):
+def wait_with_stderr_tail(process, timeout=None):
+    """Drain stderr on a thread, keeping only the last lines, so long encodes do not pile up progress output."""
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    reader = threading.Thread(target=lambda: tail.extend(process.stderr), daemon=True)
+    reader.start()
+    return_code = process.wait(timeout=timeout)
+    reader.join()
+    return return_code, ''.join(tail)
+
+def run_command(command, suppress_errors=False, timeout=None, retries=1, capture_stdout=True):
+    # Outside debug, callers that ignore stdout only need the end of stderr to report a failure
+    stream_stderr = not capture_stdout and not DEBUG and not suppress_errors
     attempt = 0
     while attempt <= retries:
         debug_print(f"Running command (Attempt {attempt+1}/{retries+1}): {command}")
-        stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
+        stdout = subprocess.PIPE if not suppress_errors and not stream_stderr else subprocess.DEVNULL
         stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
-        output, errors = [], []
         try:
-            stdout_data, stderr_data = process.communicate(timeout=timeout)
-            if stdout_data:
-                debug_print(stdout_data, end='')
-                output.append(stdout_data)
-            if stderr_data:
-                debug_print(stderr_data, end='')
-                errors.append(stderr_data)
-            return_code = process.returncode
-            output_str = ''.join(output)
-            error_str = ''.join(errors)
+            process = subprocess.Popen(command, stdout=stdout, stderr=stderr, text=True, errors='replace')
+        except OSError as ex:
+            debug_print(f"Error: {ex}")
+            return False, str(ex)
+        try:
+            if stream_stderr:
+                return_code, error_str = wait_with_stderr_tail(process, timeout)
+                output_str = ""
+            else:
+                output_str, error_str = process.communicate(timeout=timeout)
+                output_str = output_str or ""
+                error_str = error_str or ""
+                if output_str:
+                    debug_print(output_str, end='')
+                if error_str:
+                    debug_print(error_str, end='')
+                return_code = process.returncode
             debug_print(f"Command finished: return_code={return_code}")
             if return_code != 0:
                 if not suppress_errors:
@@ -56,16 +86,113 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
             if process.poll() is None:
                 process.terminate()
 
-def get_next_available_name(output_dir, start_number=1):
+def encoder_works(encoder_args):
+    # A listed encoder only means ffmpeg was built with it; one test frame shows whether this machine can run it
+    command = [
+        'ffmpeg', '-hide_banner', '-f', 'lavfi', '-i', 'color=s=256x256:d=0.1',
+        *encoder_args, '-pix_fmt', 'yuv420p', '-frames:v', '1', '-f', 'null', '-'
+    ]
+    success, _ = run_command(command, suppress_errors=True, timeout=30)
+    return success
+
+def get_encoder_args():
+    global _encoder_args
+    if _encoder_args is None:
+        _encoder_args = SOFTWARE_ENCODER_ARGS
+        success, output = run_command(['ffmpeg', '-hide_banner', '-encoders'], timeout=30)
+        if success:
+            for encoder, encoder_args in HARDWARE_ENCODER_ARGS.items():
+                if encoder in output and encoder_works(encoder_args):
+                    _encoder_args = encoder_args
+                    break
+        debug_print(f"Video encoder: {_encoder_args[1]}")
+    return _encoder_args
+
+def disable_hardware_encoder():
+    global _encoder_args
+    _encoder_args = SOFTWARE_ENCODER_ARGS
+
+def build_slide_command(image_path, output_path, width, height, duration, encoder_args):
+    return [
+        'ffmpeg', '-y', '-loop', '1', '-i', image_path,
+        *encoder_args, '-threads', '0', '-b:v', '3500k', '-r', '30', '-pix_fmt', 'yuv420p',
+        '-vf', f'scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2',
+        '-t', str(duration), output_path
+    ]
+
+def encode_slide(image_path, output_path, width, height, duration):
+    encoder_args = get_encoder_args()
+    ffmpeg_command = build_slide_command(image_path, output_path, width, height, duration, encoder_args)
+    debug_print(f"FFmpeg command: {ffmpeg_command}")
+    success, output = run_command(ffmpeg_command, capture_stdout=False)
+    if not success and encoder_args is not SOFTWARE_ENCODER_ARGS:
+        debug_print(f"Hardware encoder {encoder_args[1]} failed, falling back to libx264")
+        disable_hardware_encoder()
+        ffmpeg_command = build_slide_command(image_path, output_path, width, height, duration, SOFTWARE_ENCODER_ARGS)
+        success, output = run_command(ffmpeg_command, capture_stdout=False)
+    return success, output
+
+def get_next_available_name(output_dir, start_number=1, reserved=()):
     number = start_number
     while True:
         name = f"S_{number}{'.mp4'}"
         full_path = os.path.join(output_dir, name)
-        if not os.path.exists(full_path):
+        if full_path not in reserved and not os.path.exists(full_path):
             return name, full_path, number + 1
         number += 1
 
+def read_jpeg_size(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF:
+            f.seek(-1, 1)
+            continue
+        if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0]
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>HH', data[1:5])
+            return width, height
+        f.seek(length - 2, 1)
+
+def read_image_header_size(image_path):
+    with open(image_path, 'rb') as f:
+        head = f.read(32)
+        if head[:3] == b'\xff\xd8\xff':
+            return read_jpeg_size(f)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP' and len(head) >= 30:
+            chunk = head[12:16]
+            if chunk == b'VP8 ':
+                width, height = struct.unpack('<HH', head[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b'VP8L':
+                bits = struct.unpack('<I', head[21:25])[0]
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b'VP8X':
+                return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+    return None
+
 def get_image_dimensions(image_path):
+    try:
+        size = read_image_header_size(image_path)
+        if size and size[0] > 0 and size[1] > 0:
+            return size
+    except (OSError, struct.error):
+        pass
     try:
         with Image.open(image_path) as img:
             return img.size
@@ -133,14 +260,7 @@ def determine_best_resolution(file_paths):
             counts['portrait'] += 1
         else:
             counts['square'] += 1
-    dominant = max(counts, key=counts.get)
-    if dominant == 'landscape':
-        target_width, target_height = 1920, 1080
-    elif dominant == 'portrait':
-        target_width, target_height = 1080, 1920
-    else:
-        target_width, target_height = 1080, 1080
-    return target_width + (target_width % 2), target_height + (target_height % 2)
+    return TARGET_RESOLUTIONS[max(counts, key=counts.get)]
 
 def parse_image_names(names, folder_path):
     if not names:
@@ -152,7 +272,7 @@ def parse_image_names(names, folder_path):
             print(f"Error: No images found in {folder_path}")
             sys.exit(1)
         def get_number(file):
-            match = re.search(r'(\d+)', os.path.splitext(os.path.basename(file))[0])
+            match = NUMBER_RE.search(os.path.splitext(os.path.basename(file))[0])
             return int(match.group(1)) if match else float('inf')
         files = sorted(files, key=get_number)
         names = [os.path.splitext(os.path.basename(file))[0] for file in files]
@@ -178,14 +298,14 @@ def parse_image_names(names, folder_path):
                 print(f"Error: No images found for {name} in {folder_path}")
                 sys.exit(1)
             def get_number(file):
-                match = re.search(r'(\d+)', os.path.splitext(os.path.basename(file))[0])
+                match = NUMBER_RE.search(os.path.splitext(os.path.basename(file))[0])
                 return int(match.group(1)) if match else float('inf')
             files = sorted(files, key=get_number)
             names = [os.path.splitext(os.path.basename(file))[0] for file in files]
             debug_print(f"Wildcard matched image files: {files}")
             return names
     def get_number(name):
-        match = re.search(r'(\d+)', name)
+        match = NUMBER_RE.search(name)
         return int(match.group(1)) if match else float('inf')
     names = sorted(names, key=get_number)
     debug_print(f"Sorted image names: {names}")
@@ -199,9 +319,12 @@ def main():
     parser.add_argument("image_names", nargs='*', help="Image names or range")
     parser.add_argument("--output-dir", help="Output directory")
     parser.add_argument("--keep-original-resolution", action="store_true", help="Keep original image resolution")
+    parser.add_argument("--cpu-encode", action="store_true", help="Always encode with libx264, even if a hardware encoder is available")
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
     args = parser.parse_args()
     DEBUG = args.debug
+    if args.cpu_encode:
+        disable_hardware_encoder()
 
     duration = args.duration
     folder_path = args.folder_path
@@ -233,34 +356,35 @@ def main():
     if not os.path.exists(temp_dir):
         os.makedirs(temp_dir)
     try:
+        jobs = []
+        reserved = set()
         for i, image_path in enumerate(actual_paths, 1):
-            name, output_path, next_number = get_next_available_name(output_dir, start_number=i)
+            name, output_path, next_number = get_next_available_name(output_dir, start_number=i, reserved=reserved)
+            reserved.add(output_path)
             debug_print(f"Processing image {image_path} to {output_path}")
             if keep_original_resolution:
                 width, height = get_image_dimensions(image_path)
                 width += width % 2
                 height += height % 2
-                ffmpeg_command = (
-                    f'ffmpeg -y -loop 1 -i "{image_path}" '
-                    f'-c:v libx264 -preset fast -b:v 3500k -r 30 -pix_fmt yuv420p '
-                    f'-vf "scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2" '
-                    f'-t {duration} "{output_path}"'
-                )
             else:
-                ffmpeg_command = (
-                    f'ffmpeg -y -loop 1 -i "{image_path}" '
-                    f'-c:v libx264 -preset fast -b:v 3500k -r 30 -pix_fmt yuv420p '
-                    f'-vf "scale={target_width}:{target_height}:force_original_aspect_ratio=decrease,pad={target_width}:{target_height}:(ow-iw)/2:(oh-ih)/2" '
-                    f'-t {duration} "{output_path}"'
-                )
-            debug_print(f"FFmpeg command: {ffmpeg_command}")
-            success, output = run_command(ffmpeg_command)
+                width, height = target_width, target_height
+            jobs.append((i, image_path, output_path, width, height))
+        get_encoder_args()
+        max_workers = max(1, (os.cpu_count() or 1) // 2)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(
+                lambda job: encode_slide(job[1], job[2], job[3], job[4], duration), jobs
+            ))
+        failed = False
+        for (i, image_path, output_path, _, _), (success, output) in zip(jobs, results):
             if success and os.path.exists(output_path):
                 print(f"Saved Slide {i} as {output_path.replace(os.sep, '/')}")
             else:
                 print(f"Failed to process image {image_path} into video")
                 debug_print(f"FFmpeg output: {output}")
-                sys.exit(1)
+                failed = True
+        if failed:
+            sys.exit(1)
     finally:
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir, ignore_errors=True)
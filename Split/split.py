@@ -4,40 +4,39 @@ import os
 import argparse
 import time
 import shutil
+import json
+import glob
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 DEBUG = False
+FFMPEG = shutil.which("ffmpeg")
+FFPROBE = shutil.which("ffprobe")
+PROBE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "yt_tools", "probe_info.json")
+VIDEO_EXTENSIONS = ['.mp4', '.mkv']
+_probe_cache_lock = threading.Lock()
 
 def debug_print(*args, **kwargs):
     if DEBUG:
         print(*args, **kwargs)
 
+if os.sep == '/':
+    def display_path(path):
+        return path
+else:
+    def display_path(path):
+        return path.replace(os.sep, '/')
+
 def run_command(command, suppress_errors=False, timeout=None, retries=1):
     attempt = 0
     while attempt <= retries:
-        debug_print(f"Running command (Attempt {attempt+1}/{retries+1}): {command}")
+        if DEBUG:
+            print(f"Running command (Attempt {attempt+1}/{retries+1}): {command}")
         stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
         stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
-        output, errors = [], []
         try:
-            stdout_data, stderr_data = process.communicate(timeout=timeout)
-            if stdout_data:
-                debug_print(stdout_data, end='')
-                output.append(stdout_data)
-            if stderr_data:
-                debug_print(stderr_data, end='')
-                errors.append(stderr_data)
-            return_code = process.returncode
-            output_str = ''.join(output)
-            error_str = ''.join(errors)
-            debug_print(f"Command finished: return_code={return_code}")
-            if return_code != 0:
-                if not suppress_errors:
-                    debug_print(f"Error: return_code={return_code}. Output: {output_str}\nErrors: {error_str}")
-                return False, output_str + "\n" + error_str
-            return True, output_str
+            result = subprocess.run(command, stdout=stdout, stderr=stderr, text=True, timeout=timeout)
         except subprocess.TimeoutExpired:
-            process.kill()
             attempt += 1
             if attempt <= retries:
                 debug_print(f"Timeout after {timeout}s. Retrying {attempt}/{retries}")
@@ -45,114 +44,231 @@ def run_command(command, suppress_errors=False, timeout=None, retries=1):
                 continue
             debug_print(f"Timeout after {timeout}s. No more retries")
             return False, f"Timeout after {timeout}s"
-        except Exception as ex:
-            process.kill()
+        except OSError as ex:
             debug_print(f"Error: {ex}")
             return False, str(ex)
-        finally:
-            if process.poll() is None:
-                process.terminate()
+        output_str = result.stdout or ""
+        error_str = result.stderr or ""
+        if output_str:
+            debug_print(output_str, end='')
+        if error_str:
+            debug_print(error_str, end='')
+        if DEBUG:
+            print(f"Command finished: return_code={result.returncode}")
+        if result.returncode != 0:
+            if DEBUG and not suppress_errors:
+                print(f"Error: return_code={result.returncode}. Output: {output_str}\nErrors: {error_str}")
+            return False, output_str + "\n" + error_str
+        return True, output_str
+
+def check_dependencies():
+    if FFMPEG is None or FFPROBE is None:
+        print("Error: ffmpeg or ffprobe not found. Please install them and add them to PATH.")
+        sys.exit(1)
+
+def get_existing_names(output_dir):
+    try:
+        with os.scandir(output_dir) as entries:
+            return {os.path.normcase(entry.name) for entry in entries}
+    except OSError:
+        return set()
 
-def get_next_available_name(output_dir, prefix, extension, start_number=1):
+def get_next_available_name(output_dir, prefix, extension, start_number=1, taken=None):
+    if taken is None:
+        taken = get_existing_names(output_dir)
     number = start_number
     while True:
         name = f"{prefix}_{number}{extension}"
-        full_path = os.path.join(output_dir, name)
-        if not os.path.exists(full_path):
-            return name, full_path, number + 1
+        if os.path.normcase(name) not in taken:
+            return name, os.path.join(output_dir, name), number + 1
         number += 1
 
-def get_file_duration(file_path):
-    command = f'ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{file_path}"'
-    debug_print(f"Running ffprobe: {command}")
+def silent_remove(file_path):
+    try:
+        os.remove(file_path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def load_probe_cache():
+    try:
+        with open(PROBE_CACHE_PATH, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # Drop entries for files that have since been moved or deleted so the cache does not grow forever
+    return {path: entry for path, entry in cache.items() if isinstance(entry, dict) and os.path.exists(path)}
+
+def save_probe_cache(cache):
+    temp_path = PROBE_CACHE_PATH + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(PROBE_CACHE_PATH), exist_ok=True)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(temp_path, PROBE_CACHE_PATH)
+    except OSError as e:
+        debug_print(f"Could not save probe cache: {e}")
+
+def probe_info(file_path, cache):
+    try:
+        st = os.stat(file_path)
+        cache_path = os.path.realpath(file_path)
+    except OSError:
+        st = None
+    cached = cache.get(cache_path) if st else None
+    if cached and cached.get('mtime_ns') == st.st_mtime_ns and cached.get('size') == st.st_size:
+        debug_print(f"Cached probe: {cached}")
+        return cached['duration'], cached['audio_codec']
+    duration, audio_codec = run_probe(file_path)
+    if st and duration > 0:
+        with _probe_cache_lock:
+            cache[cache_path] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'duration': duration, 'audio_codec': audio_codec}
+    return duration, audio_codec
+
+def probe(file_path):
+    command = [FFPROBE, '-v', 'error', '-show_format', '-show_streams', '-of', 'json', file_path]
+    if DEBUG:
+        print(f"Running ffprobe: {command}")
     success, output = run_command(command)
     if not success:
         debug_print(f"ffprobe failed: {output}")
-        return 0
-    output = output.strip()
-    debug_print(f"Duration output: '{output}'")
-    if not output:
-        print(f"Warning: Empty duration for {file_path}")
-        return 0
+        return {}
     try:
-        duration = float(output)
-        debug_print(f"Duration: {duration}s")
-        return duration
+        return json.loads(output)
     except ValueError:
-        print(f"Warning: Invalid duration for {file_path}: '{output}'")
-        return 0
+        debug_print(f"Invalid ffprobe output: {output}")
+        return {}
 
-def has_audio_stream(file_path):
-    command = f'ffprobe -v error -show_streams -select_streams a -of default=noprint_wrappers=1 "{file_path}"'
-    debug_print(f"Checking audio: {command}")
-    success, output = run_command(command)
-    return bool(output.strip())
+def run_probe(file_path):
+    info = probe(file_path)
+    if not info:
+        return 0, None
+    streams = info.get('streams', [])
+    audio_codec = next((st.get('codec_name', '') for st in streams if st.get('codec_type') == 'audio'), None)
+    duration_str = str(info.get('format', {}).get('duration', ''))
+    if DEBUG:
+        print(f"Duration output: '{duration_str}', audio codec: {audio_codec}")
+    if not duration_str:
+        print(f"Warning: Empty duration for {file_path}")
+        return 0, audio_codec
+    try:
+        duration = float(duration_str)
+        if DEBUG:
+            print(f"Duration: {duration}s")
+        return duration, audio_codec
+    except ValueError:
+        print(f"Warning: Invalid duration for {file_path}: '{duration_str}'")
+        return 0, audio_codec
 
 def find_video_file(video_path, base_dir=None):
-    extensions = ['.mp4', '.mkv']
+    extensions = VIDEO_EXTENSIONS
     base, ext = os.path.splitext(video_path)
     if ext.lower() in extensions and os.path.exists(video_path):
         return video_path
     directory = os.path.abspath(os.path.dirname(video_path) or (base_dir or ""))
     base_name = os.path.splitext(os.path.basename(video_path))[0].lower()
-    debug_print(f"Searching for video '{base_name}' in '{directory}'")
+    if DEBUG:
+        print(f"Searching for video '{base_name}' in '{directory}'")
     try:
-        matched_files = []
-        for file in os.listdir(directory):
-            file_lower = file.lower()
-            file_base, file_ext = os.path.splitext(file_lower)
-            if file_base == base_name and file_ext in extensions:
-                matched_files.append(os.path.join(directory, file))
-        if matched_files:
-            for ext in extensions:
-                for match in matched_files:
-                    if match.lower().endswith(ext):
-                        debug_print(f"Found video: {match}")
-                        return match
-            return matched_files[0]
+        best = None
+        best_rank = len(extensions)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                file_base, file_ext = os.path.splitext(entry.name.lower())
+                if file_base == base_name and file_ext in extensions:
+                    rank = extensions.index(file_ext)
+                    if rank < best_rank:
+                        best, best_rank = entry.path, rank
+                        if best_rank == 0:
+                            break
+        if best:
+            if DEBUG:
+                print(f"Found video: {best}")
+            return best
     except Exception as e:
         print(f"Error accessing directory {directory}: {e}")
     return None
 
+def find_batch_inputs(input_path):
+    if os.path.isdir(input_path):
+        with os.scandir(input_path) as entries:
+            files = [entry.path for entry in entries
+                     if entry.is_file() and os.path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS]
+    elif glob.has_magic(input_path):
+        files = [f for f in glob.glob(input_path) if os.path.splitext(f)[1].lower() in VIDEO_EXTENSIONS]
+    else:
+        return None
+    return sorted(files, key=lambda x: x.lower())
+
+def split_file(actual_input, video_path, audio_path, probe_cache):
+    file_duration, audio_codec = probe_info(actual_input, probe_cache)
+    has_audio = audio_codec is not None
+    if file_duration < 5:
+        print(f"Warning: Input duration {file_duration}s is less than 5s. Using full duration.")
+    # One ffmpeg pass reads the input once and writes both outputs
+    ffmpeg_command = [FFMPEG, '-y', '-i', actual_input, '-map', '0:v:0', '-c:v', 'copy', '-an', '-t', '5', video_path]
+    if has_audio:
+        # AAC sources already fit the .m4a output, so copy instead of re-encoding
+        audio_args = ['-c:a', 'copy'] if audio_codec == 'aac' else ['-c:a', 'aac', '-b:a', '128k']
+        ffmpeg_command += ['-map', '0:a:0', '-vn', *audio_args, '-t', '5', audio_path]
+    success, output = run_command(ffmpeg_command)
+    if not success:
+        print(f"Split failed for {actual_input}: {output}")
+        silent_remove(video_path)
+        if has_audio:
+            silent_remove(audio_path)
+        return False
+    print(f"Saved video as {display_path(video_path)}")
+    if has_audio:
+        print(f"Saved audio as {display_path(audio_path)}")
+    else:
+        print(f"No audio stream in {actual_input}")
+    return True
+
 def main():
     global DEBUG
     parser = argparse.ArgumentParser(description="Split video into video and audio (first 5 seconds)")
-    parser.add_argument("input_path", help="Input video file")
+    parser.add_argument("input_path", help="Input video file, or a folder or glob pattern to split every video in it")
     parser.add_argument("--output-dir", help="Output directory")
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
     args = parser.parse_args()
     DEBUG = args.debug
+    check_dependencies()
 
     input_path = args.input_path
-    output_dir = args.output_dir or os.path.dirname(os.path.abspath(input_path)) or "."
-    actual_input = find_video_file(input_path)
-    if not actual_input or not os.path.exists(actual_input):
-        print(f"Error: No input found: {input_path}")
-        sys.exit(1)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    file_duration = get_file_duration(actual_input)
-    if file_duration < 5:
-        print(f"Warning: Input duration {file_duration}s is less than 5s. Using full duration.")
-    video_name, video_path, next_number = get_next_available_name(output_dir, "v", ".mp4")
-    audio_name, audio_path, _ = get_next_available_name(output_dir, "a", ".m4a", start_number=next_number-1)
-    ffmpeg_command = f'ffmpeg -y -i "{actual_input}" -c:v copy -an -t 5 "{video_path}"'
-    success, output = run_command(ffmpeg_command)
-    if success:
-        print(f"Saved video as {video_path.replace(os.sep, '/')}")
-        if has_audio_stream(actual_input):
-            ffmpeg_command = f'ffmpeg -y -i "{actual_input}" -vn -c:a aac -b:a 128k -t 5 "{audio_path}"'
-            success, output = run_command(ffmpeg_command)
-            if success:
-                print(f"Saved audio as {audio_path.replace(os.sep, '/')}")
-            else:
-                print(f"Audio extraction failed for {actual_input}: {output}")
-                os.remove(video_path)
-                sys.exit(1)
-        else:
-            print(f"No audio stream in {actual_input}")
+    batch_inputs = find_batch_inputs(input_path)
+    if batch_inputs is not None:
+        if not batch_inputs:
+            print(f"Error: No input found: {input_path}")
+            sys.exit(1)
+        # Batch outputs go to a subfolder so a second run does not pick up the first run's v_N.mp4 files as inputs
+        input_dir = os.path.abspath(input_path) if os.path.isdir(input_path) else os.path.dirname(os.path.abspath(input_path))
+        output_dir = args.output_dir or os.path.join(input_dir, "split")
+        actual_inputs = batch_inputs
     else:
-        print(f"Split failed for {actual_input}: {output}")
+        output_dir = args.output_dir or os.path.dirname(os.path.abspath(input_path)) or "."
+        actual_input = find_video_file(input_path)
+        if not actual_input or not os.path.exists(actual_input):
+            print(f"Error: No input found: {input_path}")
+            sys.exit(1)
+        actual_inputs = [actual_input]
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Scan the output folder once and reserve every output name up front so concurrent splits never collide
+    jobs = []
+    taken = get_existing_names(output_dir)
+    for actual_input in actual_inputs:
+        video_name, video_path, next_number = get_next_available_name(output_dir, "v", ".mp4", taken=taken)
+        audio_name, audio_path, _ = get_next_available_name(output_dir, "a", ".m4a", start_number=next_number-1, taken=taken)
+        taken.update((os.path.normcase(video_name), os.path.normcase(audio_name)))
+        jobs.append((actual_input, video_path, audio_path))
+    # Read the probe cache once for the whole batch and write it back once at the end
+    probe_cache = load_probe_cache()
+    max_workers = max(1, min(os.cpu_count() or 1, len(jobs)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda job: split_file(*job, probe_cache), jobs))
+    save_probe_cache(probe_cache)
+    if not all(results):
         sys.exit(1)
 
 if __name__ == "__main__":
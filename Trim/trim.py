@@ -2,91 +2,219 @@ import subprocess
 import sys
 import os
 import argparse
+import shutil
+import glob
+from concurrent.futures import ThreadPoolExecutor
 
 DEBUG = False
+FFMPEG = shutil.which("ffmpeg")
+FFPROBE = shutil.which("ffprobe")
+VIDEO_EXTENSIONS = ['.mp4', '.mkv']
 
 def debug_print(*args, **kwargs):
     if DEBUG:
         print(*args, **kwargs)
 
+if os.sep == '/':
+    def display_path(path):
+        return path
+else:
+    def display_path(path):
+        return path.replace(os.sep, '/')
+
 def run_command(command, suppress_errors=False):
-    debug_print(f"Running command: {command}")
+    if DEBUG:
+        print(f"Running command: {command}")
     stdout = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
     stderr = subprocess.PIPE if not suppress_errors else subprocess.DEVNULL
-    process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr, text=True)
-    stdout_data, stderr_data = process.communicate()
-    output = stdout_data or ""
-    errors = stderr_data or ""
-    debug_print(f"Command finished: return_code={process.returncode}")
-    if process.returncode != 0 and not suppress_errors:
-        debug_print(f"Error output: {output}\n{errors}")
-    return process.returncode == 0, output + "\n" + errors
-
-def get_next_available_name(output_dir, prefix, extension, start_number=1):
+    try:
+        result = subprocess.run(command, stdout=stdout, stderr=stderr, text=True)
+    except OSError as ex:
+        debug_print(f"Error: {ex}")
+        return False, str(ex)
+    output = result.stdout or ""
+    errors = result.stderr or ""
+    if DEBUG:
+        print(f"Command finished: return_code={result.returncode}")
+    if DEBUG and result.returncode != 0 and not suppress_errors:
+        print(f"Error output: {output}\n{errors}")
+    return result.returncode == 0, output + "\n" + errors
+
+def check_dependencies():
+    if FFMPEG is None or FFPROBE is None:
+        print("Error: ffmpeg or ffprobe not found. Please install them and add them to PATH.")
+        sys.exit(1)
+
+def get_existing_names(output_dir):
+    try:
+        with os.scandir(output_dir) as entries:
+            return {os.path.normcase(entry.name) for entry in entries}
+    except OSError:
+        return set()
+
+def get_next_available_name(output_dir, prefix, extension, start_number=1, taken=None):
+    if taken is None:
+        taken = get_existing_names(output_dir)
     number = start_number
     while True:
         name = f"{prefix}_{number}{extension}"
-        full_path = os.path.join(output_dir, name)
-        if not os.path.exists(full_path):
-            return name, full_path, number + 1
+        if os.path.normcase(name) not in taken:
+            return name, os.path.join(output_dir, name), number + 1
         number += 1
 
+def silent_remove(file_path):
+    try:
+        os.remove(file_path)
+        return True
+    except FileNotFoundError:
+        return False
+
 def find_video_file(video_path):
-    extensions = ['.mp4', '.mkv']
+    extensions = VIDEO_EXTENSIONS
     if os.path.splitext(video_path)[1].lower() in extensions and os.path.exists(video_path):
         return video_path
     directory = os.path.dirname(video_path) or "."
     base_name = os.path.splitext(os.path.basename(video_path))[0].lower()
-    debug_print(f"Searching for video '{base_name}' in '{directory}'")
-    for file in os.listdir(directory):
-        if file.lower().startswith(base_name) and os.path.splitext(file)[1].lower() in extensions:
-            debug_print(f"Found video: {os.path.join(directory, file)}")
-            return os.path.join(directory, file)
+    if DEBUG:
+        print(f"Searching for video '{base_name}' in '{directory}'")
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            file_lower = entry.name.lower()
+            if file_lower.startswith(base_name) and os.path.splitext(file_lower)[1] in extensions:
+                if DEBUG:
+                    print(f"Found video: {entry.path}")
+                return entry.path
     return None
 
+def find_batch_inputs(input_path):
+    if os.path.isdir(input_path):
+        with os.scandir(input_path) as entries:
+            files = [entry.path for entry in entries
+                     if entry.is_file() and os.path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS]
+    elif glob.has_magic(input_path):
+        files = [f for f in glob.glob(input_path) if os.path.splitext(f)[1].lower() in VIDEO_EXTENSIONS]
+    else:
+        return None
+    return sorted(files, key=lambda x: x.lower())
+
+def starts_on_keyframe(file_path, start_time):
+    # Seek like ffmpeg would and check whether the first video packet is a keyframe at start_time
+    command = [
+        FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+        '-read_intervals', f'{start_time}%+#1',
+        '-show_entries', 'packet=pts_time,flags:stream=r_frame_rate', '-of', 'compact', file_path
+    ]
+    success, output = run_command(command)
+    if not success:
+        return False
+    packet = None
+    frame_interval = 1 / 30
+    for line in output.splitlines():
+        section, _, rest = line.strip().partition('|')
+        fields = dict(field.partition('=')[::2] for field in rest.split('|') if field)
+        if section == 'packet' and packet is None:
+            packet = fields
+        elif section == 'stream':
+            num, _, den = fields.get('r_frame_rate', '').partition('/')
+            try:
+                frame_interval = float(den or 1) / float(num)
+            except (ValueError, ZeroDivisionError):
+                pass
+    if not packet or not packet.get('flags', '').startswith('K'):
+        return False
+    try:
+        return abs(float(packet['pts_time']) - start_time) <= frame_interval
+    except (KeyError, ValueError):
+        return False
+
+def build_trim_command(actual_input, part_path, start_time, duration, video_args):
+    # Seek before -i so ffmpeg jumps to the start instead of decoding up to it
+    return [
+        FFMPEG, '-y', '-ss', str(start_time), '-i', actual_input, '-t', str(duration),
+        *video_args, '-c:a', 'aac', '-b:a', '128k', '-f', 'mp4', part_path
+    ]
+
+def trim_file(actual_input, output_path, start_time, duration, preset, threads):
+    part_path = output_path + ".part"
+    encode_args = ['-c:v', 'libx264', '-preset', preset, '-threads', str(threads)]
+    success = False
+    if starts_on_keyframe(actual_input, start_time):
+        if DEBUG:
+            print(f"Start time {start_time}s is on a keyframe in {actual_input}, copying video stream")
+        success, output = run_command(build_trim_command(actual_input, part_path, start_time, duration, ['-c:v', 'copy']))
+        # Codecs mp4 cannot carry (VP8, Theora, ...) make the copy fail; encode those like any other trim
+        if not success and DEBUG:
+            print(f"Stream copy failed for {actual_input}, re-encoding: {output}")
+    if not success:
+        success, output = run_command(build_trim_command(actual_input, part_path, start_time, duration, encode_args))
+    if success:
+        os.replace(part_path, output_path)
+        print(f"Saved video as {output_path}")
+        return True
+    silent_remove(part_path)
+    print(f"Trim failed for {actual_input}: {output}")
+    return False
+
 def main():
     global DEBUG
     parser = argparse.ArgumentParser(description="Trim video between start and end times")
     parser.add_argument("type", choices=["v"], help="Output type (v for video)")
-    parser.add_argument("input_path", help="Input video file")
+    parser.add_argument("input_path", help="Input video file, or a folder or glob pattern to trim every video in it")
     parser.add_argument("--start-time", type=float, required=True, help="Start time in seconds")
     parser.add_argument("--end-time", type=float, required=True, help="End time in seconds")
     parser.add_argument("--output-dir", help="Output directory")
+    parser.add_argument("--preset", help="x264 preset for re-encoded trims (default: fast, or ultrafast for trims over 60s)")
+    parser.add_argument("--fast", action="store_true", help="Use the ultrafast x264 preset")
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
     args = parser.parse_args()
     DEBUG = args.debug
+    check_dependencies()
 
     input_path = args.input_path
-    output_dir = args.output_dir or os.path.join(os.path.dirname(input_path), "split")
-    actual_input = find_video_file(input_path)
-    if not actual_input:
-        print(f"Error: No input found: {input_path}")
-        sys.exit(1)
+    batch_inputs = find_batch_inputs(input_path)
+    if batch_inputs is not None:
+        if not batch_inputs:
+            print(f"Error: No input found: {input_path}")
+            sys.exit(1)
+        input_dir = input_path if os.path.isdir(input_path) else os.path.dirname(input_path)
+        output_dir = args.output_dir or os.path.join(input_dir, "split")
+        actual_inputs = batch_inputs
+    else:
+        output_dir = args.output_dir or os.path.join(os.path.dirname(input_path), "split")
+        actual_input = find_video_file(input_path)
+        if not actual_input:
+            print(f"Error: No input found: {input_path}")
+            sys.exit(1)
+        actual_inputs = [actual_input]
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
 
     # Calculate duration
     duration = args.end_time - args.start_time
     if duration <= 0:
         print(f"Error: End time ({args.end_time}s) must be greater than start time ({args.start_time}s).")
         sys.exit(1)
+    preset = args.preset or ("ultrafast" if args.fast or duration > 60 else "fast")
 
-    # Construct output path with incrementing number
-    base_name = os.path.splitext(os.path.basename(actual_input))[0]
-    output_name, output_path, _ = get_next_available_name(output_dir, f"V_{base_name}", ".mp4")
-    output_path = output_path.replace(os.sep, '/')
-
-    # FFmpeg command matching manual approach exactly
-    ffmpeg_command = (
-        f'ffmpeg -y -i "{actual_input}" -ss {args.start_time} -t {duration} '
-        f'-c:v libx264 -c:a aac -b:a 128k -preset fast "{output_path}"'
-    )
-    success, output = run_command(ffmpeg_command)
-    if success:
-        print(f"Saved video as {output_path}")
-    else:
-        print(f"Trim failed for {actual_input}: {output}")
+    # Construct output paths with incrementing numbers, reserved up front for concurrent trims
+    # from a single scan of the output folder
+    jobs = []
+    taken = get_existing_names(output_dir)
+    for actual_input in actual_inputs:
+        base_name = os.path.splitext(os.path.basename(actual_input))[0]
+        output_name, output_path, _ = get_next_available_name(output_dir, f"V_{base_name}", ".mp4", taken=taken)
+        taken.add(os.path.normcase(output_name))
+        jobs.append((actual_input, display_path(output_path)))
+
+    # Share the cores between concurrent trims so a batch does not start one full-width x264 per file
+    cpu_count = os.cpu_count() or 1
+    max_workers = max(1, min(cpu_count, len(jobs)))
+    threads = max(1, cpu_count // max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(
+            lambda job: trim_file(job[0], job[1], args.start_time, duration, preset, threads), jobs
+        ))
+    if not all(results):
         sys.exit(1)
 
 if __name__ == "__main__":